@@ -0,0 +1,66 @@
+import functions_framework
+import json
+import logging
+import os
+
+
+from projects.archive import WalletArchiver
+from projects.bootstrap import create_archive_store, create_profiler, create_registry, setup_logging
+from projects.structured_logging import set_request_id
+
+
+setup_logging()
+
+# Idle wallets are moved to a Cloud Storage bucket or a local directory
+archive_store = create_archive_store()
+
+# Only set at deploy time, a shorter period would archive wallets still in use
+MIN_IDLE_DAYS = 7
+idle_days = int(os.getenv('ARCHIVE_IDLE_DAYS', 90))
+if idle_days < MIN_IDLE_DAYS:
+    raise ValueError(f"ARCHIVE_IDLE_DAYS must be at least {MIN_IDLE_DAYS}.")
+
+registry = create_registry(initialize_default=False, archive_store=archive_store)
+
+profiler = create_profiler()
+
+logger = logging.getLogger(__name__)
+
+
+@functions_framework.http
+@profiler.profile
+def archive_wallets(request):
+    """HTTP function called by Cloud Scheduler to archive idle wallets"""
+    set_request_id(request)
+    try:
+        tenant_id = registry.resolve(request)
+    except ValueError as e:
+        response = {"status": "error", "message": str(e)}
+        return (json.dumps(response), 400, {'Content-Type': 'application/json'})
+
+    try:
+        if not archive_store:
+            raise ValueError("ARCHIVE_BUCKET or ARCHIVE_DIR is not set.")
+
+        # Archive the idle wallets of the request tenant
+        with registry.use(tenant_id) as (secure_db, _):
+            archiver = WalletArchiver(secure_db.db, archive_store, idle_days)
+            archived = archiver.archive_idle_wallets()
+
+        # Return success response
+        response = {
+            "status": "success",
+            "message": f"Archived {archived} wallets idle for {idle_days} days",
+            "archived": archived
+        }
+        return (json.dumps(response), 200, {'Content-Type': 'application/json'})
+
+    except Exception as e:
+        logger.exception("Wallet archive failed: %s", e, extra={'event': 'archive_failed'})
+
+        # Handle any errors
+        response = {
+            "status": "error",
+            "message": str(e)
+        }
+        return (json.dumps(response), 500, {'Content-Type': 'application/json'})
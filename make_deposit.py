@@ -1,24 +1,34 @@
 import functions_framework
 import json
+import logging
 
 
-from projects.unsecure_project import Unsecure
-from projects.secure_project import Secure
+from projects.bootstrap import (
+    create_analytics, create_archive_store, create_profiler, create_registry, setup_logging)
+from projects.structured_logging import set_request_id
 
 
-# Initialize Firestore DB and Pub/Sub
-secure_project_id = "xenon-sunspot-429207-s0"
-unsecure_project_id = "nifty-kayak-435509-d6"
-secure_app_name = "secure_app"
-unsecure_app_name = "unsecure_app"
+setup_logging()
 
-# Initialize both projects
-unsecure_db = Unsecure(unsecure_project_id, unsecure_app_name)
-secure_db = Secure(secure_project_id, secure_app_name, unsecure_db)
+# Archived wallets are restored from the archive when they get a deposit
+registry = create_registry(
+    analytics=create_analytics(), archive_store=create_archive_store())
+
+profiler = create_profiler()
+
+logger = logging.getLogger(__name__)
 
 
 @functions_framework.http
+@profiler.profile
 def make_deposit(request):
+    set_request_id(request)
+    try:
+        tenant_id = registry.resolve(request)
+    except ValueError as e:
+        response = {"status": "error", "message": str(e)}
+        return (json.dumps(response), 400, {'Content-Type': 'application/json'})
+
     try:
         # Parse request body
         request_json = request.get_json()
@@ -26,7 +36,8 @@ def make_deposit(request):
         amount = float(request_json['amount'])
 
         # Perform the deposit in the secure system
-        secure_db.deposit_to_wallet(wallet_number, amount)
+        with registry.use(tenant_id) as (secure_db, _):
+            secure_db.deposit_to_wallet(wallet_number, amount)
 
         # Return success response
         response = {
@@ -44,6 +55,8 @@ def make_deposit(request):
         return (json.dumps(response), 400, {'Content-Type': 'application/json'})
 
     except Exception as e:
+        logger.exception("Deposit failed: %s", e, extra={'event': 'deposit_failed'})
+
         # Handle any other errors
         response = {
             "status": "error",
@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from google.cloud import bigquery
+
+
+logger = logging.getLogger(__name__)
+
+
+def to_json_row(event):
+    """Convert an event to a JSON serializable row"""
+
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in event.items()
+    }
+
+
+class BigQuerySink:
+    def __init__(self, table_id, use_load_job=False, client=None):
+        self.client = client or bigquery.Client()
+
+        self.table_id = table_id  # project.dataset.table
+        # Load jobs are free but slower than streaming inserts
+        self.use_load_job = use_load_job
+
+    def write(self, events):
+        """Write a batch of events to the BigQuery table"""
+
+        rows = [to_json_row(event) for event in events]
+
+        if self.use_load_job:
+            self.client.load_table_from_json(rows, self.table_id).result()
+        else:
+            errors = self.client.insert_rows_json(self.table_id, rows)
+            if errors:
+                raise RuntimeError(f"BigQuery insert errors: {errors}")
+
+
+class NdjsonSink:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, events):
+        """Append a batch of events to the NDJSON file of each event type"""
+
+        by_type = {}
+        for event in events:
+            by_type.setdefault(event['event_type'], []).append(event)
+
+        for event_type, rows in by_type.items():
+            path = os.path.join(self.directory, f"{event_type}.ndjson")
+            with open(path, 'a', encoding='utf-8') as file:
+                for row in rows:
+                    file.write(json.dumps(to_json_row(row)) + '\n')
+
+
+class AnalyticsExporter:
+    def __init__(self, sink, max_batch_size=500, max_interval_seconds=30):
+        self.sink = sink
+
+        # Flush when the batch is full or its oldest event is too old
+        self.max_batch_size = max_batch_size
+        self.max_interval_seconds = max_interval_seconds
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._oldest = None  # monotonic time of the oldest buffered event
+        self._closed = False
+
+        # Single worker keeps batches in order and off the request path
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='analytics')
+
+        # Timer that flushes a buffer no new event came to push out
+        self._stopped = threading.Event()
+        self._timer = threading.Thread(
+            target=self._flush_on_interval, name='analytics-timer', daemon=True)
+        self._timer.start()
+
+        atexit.register(self.close)
+
+    def record(self, event_type, **fields):
+        """Buffer an event, the batch is written in the background"""
+
+        event = {
+            'event_type': event_type,
+            'created_at': datetime.now(timezone.utc),
+            **fields
+        }
+
+        with self._lock:
+            if self._closed:
+                logger.warning("Analytics export is closed, %s event dropped", event_type,
+                               extra={'event': 'analytics_event_dropped'})
+                return
+
+            self._buffer.append(event)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+            if not self._batch_due():
+                return
+
+            batch = self._take_batch()
+
+        self._submit(batch)
+
+    def flush(self):
+        """Write the buffered events and wait for all batches to finish"""
+
+        with self._lock:
+            batch = self._take_batch()
+
+        if batch:
+            self._submit(batch)
+
+        # Batches run in order, so this returns after all of them
+        self._executor.submit(lambda: None).result()
+
+    def close(self):
+        """Flush the buffered events and stop the background worker"""
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        self._stopped.set()
+        self._timer.join()
+
+        self.flush()
+        self._executor.shutdown(wait=True)
+        atexit.unregister(self.close)
+
+    def _batch_due(self):
+        return (len(self._buffer) >= self.max_batch_size
+                or time.monotonic() - self._oldest >= self.max_interval_seconds)
+
+    def _take_batch(self):
+        batch = self._buffer
+        self._buffer = []
+        self._oldest = None
+        return batch
+
+    def _flush_on_interval(self):
+        while not self._stopped.wait(max(self.max_interval_seconds / 2, 0.1)):
+            with self._lock:
+                if not self._buffer or not self._batch_due():
+                    continue
+                batch = self._take_batch()
+
+            self._submit(batch)
+
+    def _submit(self, batch):
+        try:
+            self._executor.submit(self._write, batch)
+        except RuntimeError as e:
+            # The worker was shut down, the interpreter is exiting
+            logger.warning("Dropped %s analytics events: %s", len(batch), e,
+                           extra={'event': 'analytics_event_dropped'})
+
+    def _write(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception as e:
+            logger.exception("Failed to export %s analytics events: %s", len(batch), e,
+                             extra={'event': 'analytics_export_failed'})
@@ -0,0 +1,183 @@
+import gzip
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+from google.api_core import exceptions
+from google.cloud import storage
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_value(value):
+    # Datetimes are tagged so they come back as datetimes
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+class LocalArchiveStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, chunk_name, data):
+        """Write a compressed chunk"""
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, chunk_name), 'wb') as file:
+            file.write(data)
+
+    def read(self, chunk_name):
+        """Read a compressed chunk"""
+
+        with open(os.path.join(self.directory, chunk_name), 'rb') as file:
+            return file.read()
+
+
+class StorageArchiveStore:
+    def __init__(self, bucket_name, prefix='wallet-archive', client=None):
+        client = client or storage.Client()
+
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def write(self, chunk_name, data):
+        """Upload a compressed chunk"""
+
+        self.bucket.blob(f"{self.prefix}/{chunk_name}").upload_from_string(
+            data, content_type='application/gzip')
+
+    def read(self, chunk_name):
+        """Download a compressed chunk"""
+
+        return self.bucket.blob(f"{self.prefix}/{chunk_name}").download_as_bytes()
+
+
+class WalletArchiver:
+    def __init__(self, db, store, idle_days=90, chunk_size=500):
+        self.db = db
+        self.store = store
+
+        # Wallets not rented for idle_days are moved to the store
+        self.idle_days = idle_days
+        self.chunk_size = chunk_size
+
+    def archive_idle_wallets(self, now=None):
+        """Move idle wallets to compressed NDJSON chunks and leave tombstones, return the number archived"""
+
+        now = now or datetime.now(timezone.utc)
+        cutoff = now - timedelta(days=self.idle_days)
+        archived = 0
+        last_wallet = None
+
+        while True:
+            query = self.db.collection('wallets').where(
+                filter=FieldFilter('is_rented', '==', False)).where(
+                filter=FieldFilter('rental_expiry', '<', cutoff)).order_by('rental_expiry')
+            # Wallets skipped for recent deposits stay in the query, page past them
+            if last_wallet:
+                query = query.start_after(last_wallet)
+            wallets = query.limit(self.chunk_size).get()
+
+            if not wallets:
+                break
+
+            # Deposits after the rental ended keep a wallet active
+            idle_wallets = [wallet for wallet in wallets
+                            if not self._active_since(wallet, cutoff)]
+            if idle_wallets:
+                archived += self._archive_chunk(idle_wallets, now)
+
+            if len(wallets) < self.chunk_size:
+                break
+            last_wallet = wallets[-1]
+
+        logger.info("Archived %s idle wallets", archived,
+                    extra={'event': 'wallets_archived', 'count': archived})
+
+        return archived
+
+    def rehydrate(self, tombstone):
+        """Restore an archived wallet from its chunk and return the restored snapshot"""
+
+        tombstone_data = tombstone.to_dict()
+        chunk = gzip.decompress(self.store.read(tombstone_data['archive_chunk']))
+
+        for line in chunk.decode('utf-8').splitlines():
+            record = json.loads(line)
+            if record['id'] == tombstone.id:
+                wallet_data = {key: decode_value(value)
+                               for key, value in record['data'].items()}
+                break
+        else:
+            raise ValueError(f"Wallet {tombstone.id} is not in its archive chunk.")
+
+        # Fields written to the tombstone after archiving are newer than the chunk
+        newer = {key: value for key, value in tombstone_data.items()
+                 if key not in ('archived', 'archive_chunk')}
+        restored = {'archived': firestore.DELETE_FIELD,
+                    'archive_chunk': firestore.DELETE_FIELD, **wallet_data, **newer}
+
+        # Another request may have restored the wallet already
+        option = self.db.write_option(last_update_time=tombstone.update_time)
+        try:
+            tombstone.reference.update(restored, option=option)
+        except exceptions.FailedPrecondition:
+            return tombstone.reference.get()
+
+        logger.info("Wallet %s rehydrated", wallet_data['number'],
+                    extra={'event': 'wallet_rehydrated', 'wallet_number': wallet_data['number']})
+
+        return tombstone.reference.get()
+
+    def _active_since(self, wallet, cutoff):
+        last_activity = wallet.to_dict().get('last_activity')
+        return last_activity is not None and last_activity >= cutoff
+
+    def _archive_chunk(self, wallets, now):
+        chunk_name = f"wallets-{now.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.ndjson.gz"
+
+        lines = [
+            json.dumps({
+                'id': wallet.id,
+                'data': {key: encode_value(value) for key, value in wallet.to_dict().items()}
+            })
+            for wallet in wallets
+        ]
+        # The chunk is stored before any wallet points to it
+        self.store.write(chunk_name, gzip.compress('\n'.join(lines).encode('utf-8')))
+
+        archived = 0
+        for wallet in wallets:
+            wallet_data = wallet.to_dict()
+            # The number stays on the tombstone, so deposits can still find the wallet
+            tombstone = {field: firestore.DELETE_FIELD for field in wallet_data}
+            tombstone.update({
+                'wallet_uid': wallet_data.get('wallet_uid', wallet.id),
+                'number': wallet_data['number'],
+                'archived': True,
+                'archive_chunk': chunk_name,
+            })
+
+            # Skip the wallet if it was rented since it was read
+            option = self.db.write_option(last_update_time=wallet.update_time)
+            try:
+                wallet.reference.update(tombstone, option=option)
+            except (exceptions.FailedPrecondition, exceptions.NotFound):
+                continue
+
+            archived += 1
+
+        return archived
@@ -0,0 +1,53 @@
+import json
+import os
+
+from projects.analytics import AnalyticsExporter, BigQuerySink
+from projects.archive import LocalArchiveStore, StorageArchiveStore
+from projects.profiling import LocalProfileSink, RequestProfiler, StorageProfileSink
+from projects.structured_logging import configure_logging
+from projects.tenants import DEFAULT_TENANT, TenantRegistry, load_tenants
+
+
+def setup_logging():
+    """Structured logs, written by a background thread"""
+
+    configure_logging(
+        sample_rates=json.loads(os.getenv('LOG_SAMPLE_RATES', '{}')),
+        cloud_logging=os.getenv('CLOUD_LOGGING') == '1')
+
+
+def create_analytics():
+    """Export rental, expiry and deposit events to BigQuery if a table is set"""
+
+    analytics_table = os.getenv('ANALYTICS_TABLE')
+    return AnalyticsExporter(BigQuerySink(analytics_table)) if analytics_table else None
+
+
+def create_archive_store():
+    """Archived wallets are kept in a Cloud Storage bucket or a local directory"""
+
+    archive_bucket = os.getenv('ARCHIVE_BUCKET')
+    archive_dir = os.getenv('ARCHIVE_DIR')
+    return (StorageArchiveStore(archive_bucket) if archive_bucket
+            else LocalArchiveStore(archive_dir) if archive_dir else None)
+
+
+def create_registry(initialize_default=True, **options):
+    """Pool the projects of every tenant, the default one is initialized at cold start"""
+
+    registry = TenantRegistry(load_tenants(), **options)
+    if initialize_default:
+        registry.get(DEFAULT_TENANT)
+
+    return registry
+
+
+def create_profiler():
+    """Opt-in request profiles, for signed X-Profile-Token headers or sampled"""
+
+    profile_bucket = os.getenv('PROFILE_BUCKET')
+    return RequestProfiler(
+        StorageProfileSink(profile_bucket) if profile_bucket
+        else LocalProfileSink(os.getenv('PROFILE_DIR', '/tmp/profiles')),
+        secret=os.getenv('PROFILE_SECRET'),
+        sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0')))
@@ -0,0 +1,124 @@
+import heapq
+import json
+from datetime import datetime, timezone
+
+from google.api_core import exceptions
+from google.cloud import tasks_v2
+from google.protobuf import timestamp_pb2
+
+
+def expiry_task_id(wallet_number, rental_expiry, tenant_id=None):
+    """Build a task id that is unique per wallet rental"""
+
+    # Cloud Tasks only accepts letters, numbers, hyphens and underscores
+    number = str(wallet_number).replace('.', '_').replace('-', 'm')
+    task_id = f"wallet-{number}-{int(rental_expiry.timestamp())}"
+
+    return f"{tenant_id}-{task_id}" if tenant_id else task_id
+
+
+class CloudTasksExpiryQueue:
+    def __init__(self, project_id, location, queue, handler_url,
+                 service_account_email, client=None):
+        if not handler_url:
+            raise ValueError("EXPIRY_HANDLER_URL is not set.")
+        # The handler is private, tasks authenticate with an OIDC token
+        if not service_account_email:
+            raise ValueError("EXPIRY_TASKS_SERVICE_ACCOUNT is not set.")
+
+        self.client = client or tasks_v2.CloudTasksClient()
+
+        self.project_id = project_id
+        self.location = location
+        self.queue = queue
+
+        # HTTP function that expires the wallet when the task fires
+        self.handler_url = handler_url
+        self.service_account_email = service_account_email
+
+    def schedule(self, uid, wallet_number, rental_expiry, tenant_id=None):
+        """Schedule the wallet expiry at rental_expiry, return False if it is already scheduled"""
+
+        parent = self.client.queue_path(
+            self.project_id, self.location, self.queue)
+        task_id = expiry_task_id(wallet_number, rental_expiry, tenant_id)
+
+        schedule_time = timestamp_pb2.Timestamp()
+        schedule_time.FromDatetime(rental_expiry)
+
+        http_request = tasks_v2.HttpRequest(
+            http_method=tasks_v2.HttpMethod.POST,
+            url=self.handler_url,
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'uid': uid,
+                'wallet_number': wallet_number,
+                'tenant_id': tenant_id
+            }).encode(),
+            oidc_token=tasks_v2.OidcToken(
+                service_account_email=self.service_account_email),
+        )
+
+        task = tasks_v2.Task(
+            name=self.client.task_path(
+                self.project_id, self.location, self.queue, task_id),
+            http_request=http_request,
+            schedule_time=schedule_time,
+        )
+
+        try:
+            self.client.create_task(parent=parent, task=task)
+        except exceptions.AlreadyExists:
+            # Same wallet and rental expiry, the task is already queued
+            return False
+
+        return True
+
+
+class LocalExpiryQueue:
+    def __init__(self, handler):
+        # Called with (uid, wallet_number, tenant_id) for every due task
+        self.handler = handler
+
+        self._heap = []
+        self._tasks = {}  # (tenant id, wallet number) -> (rental_expiry, seq, uid)
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def schedule(self, uid, wallet_number, rental_expiry, tenant_id=None):
+        """Schedule the wallet expiry at rental_expiry, return False if it is already scheduled"""
+
+        key = (tenant_id, wallet_number)
+
+        task = self._tasks.get(key)
+        if task and task[0] == rental_expiry and task[2] == uid:
+            return False
+
+        # A newer rental replaces the pending task of the same wallet
+        self._seq += 1
+        self._tasks[key] = (rental_expiry, self._seq, uid)
+        heapq.heappush(self._heap, (rental_expiry, self._seq, key))
+
+        return True
+
+    def run_due(self, now=None):
+        """Run every task whose rental_expiry has passed, return the number of tasks run"""
+
+        now = now or datetime.now(timezone.utc)
+        count = 0
+
+        while self._heap and self._heap[0][0] <= now:
+            rental_expiry, seq, key = heapq.heappop(self._heap)
+
+            task = self._tasks.get(key)
+            if not task or task[1] != seq:
+                continue  # Replaced by a newer rental
+
+            del self._tasks[key]
+            tenant_id, wallet_number = key
+            self.handler(task[2], wallet_number, tenant_id)
+            count += 1
+
+        return count
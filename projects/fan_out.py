@@ -0,0 +1,32 @@
+import contextvars
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from projects.profiling import track_thread
+
+
+MAX_WORKERS = 8
+
+# Shared by all requests of the instance, so the thread count stays bounded
+_executor = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix='fan_out')
+
+
+def run_concurrently(*calls):
+    """Run independent calls at the same time and return their results in order"""
+
+    # Copy the context so the request id reaches the logs of every call,
+    # and the profiler samples the threads of a profiled request
+    futures = [_executor.submit(contextvars.copy_context().run, track_thread(call))
+               for call in calls]
+
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+
+    # One call failed, the calls that did not start yet are cancelled
+    for future in not_done:
+        future.cancel()
+
+    for future in futures:
+        if future in done and future.exception():
+            raise future.exception()
+
+    return [future.result() for future in futures]
@@ -0,0 +1,244 @@
+import contextvars
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from google.cloud import storage
+
+from projects.structured_logging import request_id_var
+
+
+logger = logging.getLogger(__name__)
+
+# Profile of the current request, None when the request is not profiled
+_current_profile = contextvars.ContextVar('profile', default=None)
+
+
+def sign_profile_token(secret, expires):
+    """Build the X-Profile-Token header value that is valid until expires (unix time)"""
+
+    signature = hmac.new(secret.encode(), str(int(expires)).encode(),
+                         hashlib.sha256).hexdigest()
+    return f"{int(expires)}.{signature}"
+
+
+def timed(method):
+    """Record the wall and CPU time of the method when the request is profiled"""
+
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        profile = _current_profile.get()
+        if profile is None:
+            return method(*args, **kwargs)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profile.add(name, time.perf_counter() - wall_start,
+                        time.thread_time() - cpu_start)
+
+    return wrapper
+
+
+def track_thread(call):
+    """Sample the thread running the call when the request is profiled"""
+
+    @functools.wraps(call)
+    def wrapper(*args, **kwargs):
+        # Runs in the copied request context, on a fan out thread
+        profile = _current_profile.get()
+        if profile is None:
+            return call(*args, **kwargs)
+
+        thread_id = threading.get_ident()
+        profile.add_thread(thread_id)
+        try:
+            return call(*args, **kwargs)
+        finally:
+            profile.remove_thread(thread_id)
+
+    return wrapper
+
+
+class Profile:
+    def __init__(self):
+        self.methods = {}  # name -> {'calls', 'wall_seconds', 'cpu_seconds'}
+        self.threads = set()  # fan out threads working for the request
+        self._lock = threading.Lock()
+
+    def add_thread(self, thread_id):
+        with self._lock:
+            self.threads.add(thread_id)
+
+    def remove_thread(self, thread_id):
+        with self._lock:
+            self.threads.discard(thread_id)
+
+    def active_threads(self):
+        with self._lock:
+            return set(self.threads)
+
+    def add(self, name, wall_seconds, cpu_seconds):
+        # Methods also run on the fan out threads
+        with self._lock:
+            method = self.methods.setdefault(
+                name, {'calls': 0, 'wall_seconds': 0, 'cpu_seconds': 0})
+            method['calls'] += 1
+            method['wall_seconds'] += wall_seconds
+            method['cpu_seconds'] += cpu_seconds
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval, profile=None):
+        super().__init__(name='profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        # The fan out threads of the profiled request are sampled too
+        self.profile = profile
+
+        self.stacks = Counter()  # folded stack -> samples
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            thread_ids = {self.thread_id}
+            if self.profile:
+                thread_ids |= self.profile.active_threads()
+
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                self._sample(frames.get(thread_id))
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def folded(self):
+        """Stacks in the folded format read by flamegraph.pl and speedscope"""
+
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+class LocalProfileSink:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, profile_id, report, folded):
+        """Write the report and the folded stacks of a profile"""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, f"{profile_id}.json"), 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        with open(os.path.join(self.directory, f"{profile_id}.folded"), 'w', encoding='utf-8') as file:
+            file.write(folded)
+
+
+class StorageProfileSink:
+    def __init__(self, bucket_name, prefix='profiles', client=None):
+        client = client or storage.Client()
+
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def write(self, profile_id, report, folded):
+        """Upload the report and the folded stacks of a profile"""
+
+        self.bucket.blob(f"{self.prefix}/{profile_id}.json").upload_from_string(
+            json.dumps(report, indent=2), content_type='application/json')
+        self.bucket.blob(f"{self.prefix}/{profile_id}.folded").upload_from_string(
+            folded, content_type='text/plain')
+
+
+class RequestProfiler:
+    def __init__(self, sink, secret=None, sample_rate=0, interval=0.005):
+        self.sink = sink
+
+        # A request is profiled if it has a valid signed token or is sampled
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.interval = interval  # seconds between stack samples
+
+    def should_profile(self, request):
+        """Check the X-Profile-Token header and the sample rate"""
+
+        token = request.headers.get('X-Profile-Token')
+        if token and self.secret:
+            expires = token.split('.', 1)[0]
+            # Bytes are compared, compare_digest rejects non-ASCII strings
+            valid = (expires.isascii() and expires.isdigit() and int(expires) > time.time()
+                     and hmac.compare_digest(
+                         token.encode(), sign_profile_token(self.secret, int(expires)).encode()))
+            if valid:
+                return True
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, handler):
+        """Decorate an HTTP function so its requests can be profiled"""
+
+        @functools.wraps(handler)
+        def wrapper(request):
+            if not self.should_profile(request):
+                return handler(request)
+
+            profile = Profile()
+            token = _current_profile.set(profile)
+            sampler = StackSampler(threading.get_ident(), self.interval, profile)
+            sampler.start()
+
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                return handler(request)
+            finally:
+                wall_seconds = time.perf_counter() - wall_start
+                cpu_seconds = time.thread_time() - cpu_start
+                sampler.stop()
+                _current_profile.reset(token)
+
+                self._write(handler.__name__, profile, sampler,
+                            wall_seconds, cpu_seconds)
+
+        return wrapper
+
+    def _write(self, function_name, profile, sampler, wall_seconds, cpu_seconds):
+        profile_id = f"{function_name}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        report = {
+            'function': function_name,
+            'request_id': request_id_var.get(),
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'samples': sum(sampler.stacks.values()),
+            'methods': profile.methods,
+        }
+
+        try:
+            self.sink.write(profile_id, report, sampler.folded())
+        except Exception as e:
+            logger.exception("Failed to write profile %s: %s", profile_id, e,
+                             extra={'event': 'profile_write_failed'})
@@ -1,45 +1,129 @@
 import os
 import base64
 import json
+import logging
 from datetime import datetime, timedelta, timezone
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+from google.api_core import exceptions
 from google.cloud import pubsub_v1
 from google.cloud.firestore_v1.base_query import FieldFilter
 
+from projects.archive import WalletArchiver
+from projects.fan_out import run_concurrently
+from projects.profiling import timed
+from projects.wallet_pool import FreeWalletPool
+
+
+RENTAL_PERIOD = timedelta(minutes=5)
+
+# Wallets tried before a new one is created when claims keep conflicting
+MAX_CLAIM_ATTEMPTS = 3
+
+# Balance writes retried when the wallet changed since it was read
+MAX_WRITE_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
 
 class Secure:
-    def __init__(self, project_id, app_name, unsecure_db):
+    def __init__(self, project_id, app_name, unsecure_db, analytics=None,
+                 credentials_env='GOOGLE_APPLICATION_CREDENTIALS_BASE64_SECURE',
+                 mirror_wallets=False, archive_store=None, tenant_id=None, wallet_number=1):
         # Get encoded Private key of Secure project
-        encoded_key = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_BASE64_SECURE')
+        encoded_key = os.getenv(credentials_env)
         decoded_key = base64.b64decode(encoded_key)
         service_account_info = json.loads(decoded_key)
         cred = credentials.Certificate(service_account_info)
 
-        app = firebase_admin.initialize_app(
+        self.app = firebase_admin.initialize_app(
             cred, {'projectId': project_id}, name=app_name)
 
-        self.db = firestore.client(app=app)
+        self.db = firestore.client(app=self.app)
 
         self.project_id = project_id
+        self.tenant_id = tenant_id  # wallet numbers repeat across tenants
 
         self.publisher = pubsub_v1.PublisherClient()
 
-        self.wallet_number = 1  # start wallet number from 1
+        self.wallet_number = wallet_number  # start wallet number from 1
 
         self.unsecure_db = unsecure_db
 
+        # Rental and deposit events for reporting, skipped if not set
+        self.analytics = analytics
+
+        # In-process mirror of the unrented wallets, rentals skip the query
+        self.wallet_pool = None
+        if mirror_wallets:
+            self.wallet_pool = FreeWalletPool(self.db.collection('wallets').where(
+                filter=FieldFilter('is_rented', '==', False)))
+            self.wallet_pool.start()
+
+        # Idle wallets are moved to the archive store and restored on use
+        self.archiver = None
+        if archive_store:
+            self.archiver = WalletArchiver(self.db, archive_store)
+
+    def close(self):
+        """Close the clients and delete the Firebase app of the project"""
+
+        if self.wallet_pool:
+            self.wallet_pool.stop()
+        self.publisher.stop()
+        self.db.close()
+        firebase_admin.delete_app(self.app)
+
+    def record_event(self, event_type, **fields):
+        """Send an event to the analytics export"""
+
+        if self.analytics:
+            self.analytics.record(event_type, tenant_id=self.tenant_id, **fields)
+
+    @timed
     def find_available_wallet(self):
         """Find an available wallet (not rented)"""
 
+        if self.wallet_pool:
+            wallet = self.wallet_pool.take()
+            if wallet:
+                return wallet
+
         wallet_query = self.db.collection('wallets').where(
             filter=FieldFilter('is_rented', '==', False)).limit(1).stream()
         wallet = next(wallet_query, None)
 
         return wallet
 
+    @timed
+    def claim_wallet(self, wallet):
+        """Rent an available wallet, return False if it changed since it was read"""
+
+        wallet_update = {
+            'is_rented': True,
+            'rental_expiry': datetime.now(timezone.utc) + RENTAL_PERIOD
+        }
+
+        if not self.wallet_pool:
+            wallet.reference.update(wallet_update)
+            return True
+
+        # The mirror can be behind, only write if the wallet is unchanged
+        option = self.db.write_option(last_update_time=wallet.update_time)
+        try:
+            wallet.reference.update(wallet_update, option=option)
+        except (exceptions.FailedPrecondition, exceptions.NotFound):
+            return False
+        except Exception:
+            # The wallet may still be free, keep it in the mirror
+            self.wallet_pool.put_back(wallet)
+            raise
+
+        return True
+
+    @timed
     def create_wallet(self):
         """Create a new wallet in the secure project with private data"""
 
@@ -54,7 +138,7 @@ class Secure:
             'balance': 0,
             'is_rented': True,
             # 5 minutes rental
-            'rental_expiry': datetime.now(timezone.utc) + timedelta(minutes=5)
+            'rental_expiry': datetime.now(timezone.utc) + RENTAL_PERIOD
         }
 
         wallet_ref.set(wallet_data)
@@ -63,24 +147,31 @@ class Secure:
 
         return wallet_uid, wallet_number
 
+    @timed
     def rent_wallet(self, uid):
         """Find or create a wallet and rent it to a user for 5 minutes"""
 
+        # Read the user and look for a free wallet in both projects at once
+        user_ref, wallet = run_concurrently(
+            self.unsecure_db.db.collection('users').document(uid).get,
+            self.find_available_wallet)
+
         # Check if user exists in the database
-        user_ref = self.unsecure_db.db.collection('users').document(uid).get()
         if not user_ref.exists:
+            if wallet and self.wallet_pool:
+                self.wallet_pool.put_back(wallet)  # Not rented, keep it in the mirror
             raise ValueError(f"User with UID {uid} does not exist.")
 
-        wallet = self.find_available_wallet()
+        attempts = 1
+        while wallet and not self.claim_wallet(wallet):
+            # Another request rented the wallet after it was read
+            attempts += 1
+            wallet = (self.find_available_wallet()
+                      if attempts <= MAX_CLAIM_ATTEMPTS else None)
 
         if wallet:
             wallet_data = wallet.to_dict()
             wallet_number = wallet_data['number']
-            wallet_ref = wallet.reference
-            wallet_ref.update({
-                'is_rented': True,
-                'rental_expiry': datetime.now(timezone.utc) + timedelta(minutes=5)
-            })
         else:
             # No available wallet, create a new one
             wallet_uid, wallet_number = self.create_wallet()
@@ -89,36 +180,149 @@ class Secure:
         # Send wallet number to the unsecure project
         self.unsecure_db.link_wallet_to_user(uid, wallet_number)
 
+        self.record_event('rental', uid=uid, wallet_number=wallet_number)
+
         return wallet_data['number']
 
+    @timed
     def deposit_to_wallet(self, wallet_number, amount):
         """Deposit funds to the wallet and update the balance"""
 
         if amount < 0:
-            print("The amount is less than 0, it can't be updated.")
+            logger.warning("The amount is less than 0, it can't be updated.",
+                           extra={'event': 'deposit_rejected',
+                                  'wallet_number': wallet_number, 'amount': amount})
         else:
             wallet_ref = self.db.collection('wallets').where(
                 filter=FieldFilter('number', '==', wallet_number)).limit(1).get()
 
             if wallet_ref:
-                wallet = wallet_ref[0]  # Get the first matching document
+                # Get the first matching document, restored if it was archived
+                wallet = self.restore_wallet(wallet_ref[0])
                 wallet_data = wallet.to_dict()
+
                 rental_expiry = wallet_data.get('rental_expiry')
                 current_time = datetime.now(timezone.utc)
 
-                # Update wallet balance
-                new_balance = wallet_data['balance'] + amount
-                wallet.reference.update({'balance': new_balance})
-
                 # Check if the wallet is within the rental period
-                if rental_expiry and current_time < rental_expiry:
+                within_rental = rental_expiry and current_time < rental_expiry
+
+                def update_wallet():
+                    # Update wallet balance
+                    self.add_to_balance(wallet, amount)
+
+                def update_user():
                     # Send deposit amount to the unsecure project
                     self.unsecure_db.update_user_balance(
                         wallet_data['number'], amount
                     )
-                    wallet.reference.update(
-                        {'is_rented': False})  # Expire the wallet
+
+                if within_rental:
+                    # The two balances are written at the same time
+                    run_concurrently(update_wallet, update_user)
+
+                    # The wallet is only released once the user side succeeded
                     self.unsecure_db.unlink_wallet_from_user(
                         wallet_data['number'])
+                    wallet.reference.update(
+                        {'is_rented': False})  # Expire the wallet
                 else:
-                    print(f"Rental period expired. Deposit only updated in wallet.")
+                    update_wallet()
+
+                self.record_event(
+                    'deposit', wallet_number=wallet_data['number'], amount=amount)
+                logger.info("Deposited %s into wallet %s", amount, wallet_number,
+                            extra={'event': 'deposit',
+                                   'wallet_number': wallet_number, 'amount': amount})
+
+                if within_rental:
+                    self.record_event(
+                        'expiry', wallet_number=wallet_data['number'])
+                else:
+                    logger.info("Rental period expired. Deposit only updated in wallet.",
+                                extra={'event': 'deposit_after_expiry',
+                                       'wallet_number': wallet_number, 'amount': amount})
+
+    @timed
+    def restore_wallet(self, wallet):
+        """Restore the wallet if it is archived, return its current snapshot"""
+
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            if not wallet.to_dict().get('archived'):
+                return wallet
+
+            if not self.archiver:
+                raise ValueError(
+                    f"Wallet {wallet.to_dict().get('number')} is archived and no archive store is set.")
+
+            # Another request may have restored or changed it, check again
+            wallet = self.archiver.rehydrate(wallet)
+
+        raise exceptions.Aborted(f"Wallet {wallet.to_dict().get('number')} could not be restored.")
+
+    @timed
+    def add_to_balance(self, wallet, amount):
+        """Add the amount to the wallet balance, only if the wallet did not change since it was read"""
+
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            wallet = self.restore_wallet(wallet)
+            new_balance = wallet.to_dict()['balance'] + amount
+
+            # A blind write could land on a tombstone and be lost on rehydrate
+            option = self.db.write_option(last_update_time=wallet.update_time)
+            try:
+                wallet.reference.update({
+                    'balance': new_balance,
+                    'last_activity': datetime.now(timezone.utc)
+                }, option=option)
+            except exceptions.FailedPrecondition:
+                wallet = wallet.reference.get()  # Read the new state and try again
+                continue
+
+            return new_balance
+
+        raise exceptions.Aborted(
+            f"Wallet {wallet.to_dict().get('number')} kept changing, deposit not written.")
+
+    @timed
+    def expire_wallet(self, uid, wallet_number, force=False):
+        """Release the wallet once its rental period is over, force skips the period check"""
+
+        # Check if the wallet still exists and hasn't already been updated
+        wallet_query = self.db.collection('wallets').where(
+            filter=FieldFilter('number', '==', wallet_number)).limit(1).stream()
+        wallet = next(wallet_query, None)
+
+        if not wallet:
+            return False
+
+        wallet_data = wallet.to_dict()
+        rental_expiry = wallet_data.get('rental_expiry')
+
+        # The wallet was rented again, its own task will expire it
+        if not force and rental_expiry and datetime.now(timezone.utc) < rental_expiry:
+            logger.info("Wallet %s was rented again, skip expiry", wallet_number,
+                        extra={'event': 'expiry_skipped', 'uid': uid,
+                               'wallet_number': wallet_number})
+            return False
+
+        # Check if the wallet is still rented and if the rental has expired
+        if not wallet_data.get('is_rented', False):
+            logger.info("Wallet %s already expired for user %s", wallet_number, uid,
+                        extra={'event': 'wallet_already_expired', 'uid': uid,
+                               'wallet_number': wallet_number})
+            return False
+
+        wallet.reference.update({'is_rented': False})  # Expire the wallet
+
+        # Unlink the wallet from the user in the unsecure project
+        user_ref = self.unsecure_db.db.collection('users').document(uid)
+        # Remove rented wallet
+        user_ref.update({'rented_wallet': firestore.DELETE_FIELD})
+
+        self.record_event('expiry', uid=uid, wallet_number=wallet_number)
+        logger.info("Wallet %s expired for user %s", wallet_number, uid,
+                    extra={'event': 'wallet_expired', 'uid': uid,
+                           'wallet_number': wallet_number})
+
+        return True
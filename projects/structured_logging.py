@@ -0,0 +1,136 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+# Tenant of the projects in use, set by TenantRegistry.use()
+tenant_id_var = contextvars.ContextVar('tenant_id', default=None)
+
+# Attributes of every LogRecord, anything else was passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+def set_request_id(request=None):
+    """Set the correlation id of the current request and return it"""
+
+    request_id = None
+    if request is not None:
+        # Cloud Functions pass the trace as TRACE_ID/SPAN_ID;o=1
+        trace = request.headers.get('X-Cloud-Trace-Context')
+        request_id = (trace.split('/')[0] if trace
+                      else request.headers.get('X-Request-ID'))
+
+    request_id = request_id or uuid.uuid4().hex
+    request_id_var.set(request_id)
+
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        # Runs in the caller thread, where the request context is set
+        record.request_id = request_id_var.get()
+        if not hasattr(record, 'tenant_id'):
+            record.tenant_id = tenant_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates):
+        super().__init__()
+        # Event name -> share of records to keep, between 0 and 1
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        # Warnings and errors are never dropped
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.sample_rates.get(getattr(record, 'event', None), 1)
+        return rate >= 1 or random.random() < rate
+
+
+class TracebackQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The default prepare drops exc_info, keep the traceback as text
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', None),
+            'tenant_id': getattr(record, 'tenant_id', None),
+        }
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO, sample_rates=None, cloud_logging=False):
+    """Send the logs through a queue to a background thread that writes them"""
+
+    global _listener
+    if _listener:
+        return _listener
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    handlers = [stream_handler]
+
+    if cloud_logging:
+        try:
+            from google.cloud.logging.handlers import CloudLoggingHandler
+            import google.cloud.logging
+        except ImportError:
+            logging.getLogger(__name__).warning(
+                "google-cloud-logging is not installed, logging to stdout only")
+        else:
+            handlers.append(CloudLoggingHandler(google.cloud.logging.Client()))
+
+    # Callers only put records on the queue, writes happen in the listener
+    log_queue = queue.SimpleQueue()
+    queue_handler = TracebackQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter(sample_rates or {}))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    return _listener
@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import firebase_admin
+
+from projects.unsecure_project import Unsecure
+from projects.secure_project import Secure
+from projects.structured_logging import tenant_id_var
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = 'default'
+
+# Projects of the default tenant
+SECURE_PROJECT_ID = "xenon-sunspot-429207-s0"
+UNSECURE_PROJECT_ID = "nifty-kayak-435509-d6"
+
+
+def load_tenants():
+    """Get the default secure/unsecure project pair and the tenants added with TENANTS"""
+
+    return {
+        DEFAULT_TENANT: {
+            'secure_project_id': SECURE_PROJECT_ID,
+            'unsecure_project_id': UNSECURE_PROJECT_ID,
+            'secure_app_name': 'secure_app',
+            'unsecure_app_name': 'unsecure_app',
+        },
+        **json.loads(os.getenv('TENANTS', '{}'))
+    }
+
+
+class PooledTenant:
+    """Projects of a tenant and the number of requests using them"""
+
+    def __init__(self):
+        self.projects = None  # (secure, unsecure) once created
+        self.error = None
+        self.ready = threading.Event()
+
+        self.last_used = 0
+        self.in_use = 0
+        self.evicted = False
+
+
+class TenantRegistry:
+    def __init__(self, tenants, max_tenants=10, idle_seconds=15 * 60, analytics=None,
+                 mirror_wallets=False, archive_store=None):
+        # Tenant id -> secure/unsecure project ids, app names and credentials
+        self.tenants = tenants
+
+        # At most max_tenants pairs stay initialized, least recently used first
+        self.max_tenants = max_tenants
+        self.idle_seconds = idle_seconds
+        self.analytics = analytics
+        self.mirror_wallets = mirror_wallets
+        self.archive_store = archive_store
+
+        self._projects = OrderedDict()  # tenant id -> PooledTenant
+        # Evicted tenants still used by a request, closed once released
+        self._draining = {}
+        # Next wallet number of closed tenants, kept for when they are created again
+        self._wallet_numbers = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, request):
+        """Get the tenant id of the request"""
+
+        tenant_id = request.headers.get('X-Tenant-ID') or DEFAULT_TENANT
+
+        if tenant_id not in self.tenants:
+            raise ValueError(f"Unknown tenant {tenant_id}")
+
+        return tenant_id
+
+    @contextmanager
+    def use(self, tenant_id):
+        """Hold the Secure and Unsecure projects of a tenant open for a request"""
+
+        tenant = self._acquire(tenant_id)
+        # Log records of the request carry the tenant
+        token = tenant_id_var.set(tenant_id)
+        try:
+            yield tenant.projects
+        finally:
+            tenant_id_var.reset(token)
+            self._release(tenant_id, tenant)
+
+    def get(self, tenant_id):
+        """Get the pooled Secure and Unsecure projects of a tenant, without holding them"""
+
+        with self.use(tenant_id) as projects:
+            return projects
+
+    def evict_idle(self):
+        """Close the tenants that were not used for idle_seconds"""
+
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+
+        self._close_all(evicted)
+
+    def close(self):
+        """Close the projects of every tenant"""
+
+        with self._lock:
+            tenants = list(self._projects.items()) + list(self._draining.items())
+            self._projects.clear()
+            self._draining.clear()
+
+        self._close_all(tenants)
+
+    def _acquire(self, tenant_id):
+        now = time.monotonic()
+
+        with self._lock:
+            tenant = (self._projects.pop(tenant_id, None)
+                      or self._draining.pop(tenant_id, None))
+            created = tenant is None
+            if created:
+                tenant = PooledTenant()
+
+            # A draining tenant is reused, its apps are still registered
+            tenant.evicted = False
+            tenant.last_used = now
+            tenant.in_use += 1
+            self._projects[tenant_id] = tenant
+
+        if created:
+            # Other tenants are served while this one is built
+            try:
+                tenant.projects = self._create(tenant_id)
+            except Exception as e:
+                tenant.error = e
+                with self._lock:
+                    for pool in (self._projects, self._draining):
+                        if pool.get(tenant_id) is tenant:
+                            del pool[tenant_id]
+                    tenant.in_use -= 1
+                tenant.ready.set()
+                raise
+
+            tenant.ready.set()
+        else:
+            tenant.ready.wait()
+            if tenant.error:
+                with self._lock:
+                    tenant.in_use -= 1
+                raise tenant.error
+
+        with self._lock:
+            evicted = self._evict(now)
+
+        self._close_all(evicted)
+
+        return tenant
+
+    def _release(self, tenant_id, tenant):
+        with self._lock:
+            tenant.in_use -= 1
+            # close() may have closed the draining tenant already
+            closing = (tenant.evicted and not tenant.in_use
+                       and self._draining.get(tenant_id) is tenant)
+            if closing:
+                del self._draining[tenant_id]
+
+        if closing:
+            self._close(tenant_id, tenant)
+
+    def _create(self, tenant_id):
+        config = self.tenants[tenant_id]
+        secure_app_name = config.get('secure_app_name', f"{tenant_id}_secure_app")
+
+        unsecure_db = Unsecure(
+            config['unsecure_project_id'],
+            config.get('unsecure_app_name', f"{tenant_id}_unsecure_app"),
+            config.get('unsecure_credentials',
+                       'GOOGLE_APPLICATION_CREDENTIALS_BASE64_UNSECURE'))
+        try:
+            secure_db = Secure(
+                config['secure_project_id'],
+                secure_app_name,
+                unsecure_db,
+                self.analytics,
+                config.get('secure_credentials',
+                           'GOOGLE_APPLICATION_CREDENTIALS_BASE64_SECURE'),
+                self.mirror_wallets,
+                self.archive_store,
+                tenant_id,
+                self._wallet_numbers.get(tenant_id, 1))
+        except Exception:
+            # Leave no app registered, the next request creates the tenant again
+            self._close_project(tenant_id, unsecure_db)
+            self._delete_app(tenant_id, secure_app_name)
+            raise
+
+        return secure_db, unsecure_db
+
+    def _evict(self, now):
+        # The first tenant is always the least recently used one
+        evicted = []
+        while self._projects:
+            tenant_id, tenant = next(iter(self._projects.items()))
+            idle = now - tenant.last_used >= self.idle_seconds
+
+            if not idle and len(self._projects) <= self.max_tenants:
+                break
+
+            del self._projects[tenant_id]
+            tenant.evicted = True
+
+            # Requests still using the tenant close it when they finish
+            if tenant.in_use:
+                self._draining[tenant_id] = tenant
+            else:
+                evicted.append((tenant_id, tenant))
+
+        return evicted
+
+    def _close_all(self, tenants):
+        for tenant_id, tenant in tenants:
+            self._close(tenant_id, tenant)
+
+    def _close(self, tenant_id, tenant):
+        if not tenant.projects:
+            return  # Creation failed, nothing was pooled
+
+        secure_db, unsecure_db = tenant.projects
+        self._wallet_numbers[tenant_id] = max(
+            secure_db.wallet_number, self._wallet_numbers.get(tenant_id, 1))
+
+        # A failure on one side still closes the other
+        self._close_project(tenant_id, secure_db)
+        self._close_project(tenant_id, unsecure_db)
+
+    def _close_project(self, tenant_id, project):
+        try:
+            project.close()
+        except Exception as e:
+            logger.exception("Failed to close %s of tenant %s: %s",
+                             type(project).__name__, tenant_id, e,
+                             extra={'event': 'tenant_close_failed', 'tenant_id': tenant_id})
+
+    def _delete_app(self, tenant_id, app_name):
+        try:
+            firebase_admin.delete_app(firebase_admin.get_app(app_name))
+        except ValueError:
+            return  # The app was never initialized
+        except Exception as e:
+            logger.exception("Failed to delete app %s of tenant %s: %s", app_name, tenant_id, e,
+                             extra={'event': 'tenant_close_failed', 'tenant_id': tenant_id})
@@ -1,27 +1,40 @@
 import os
 import base64
 import json
+import logging
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
 from google.cloud.firestore_v1.base_query import FieldFilter
 
+from projects.profiling import timed
+
+
+logger = logging.getLogger(__name__)
+
 
 class Unsecure:
-    def __init__(self, project_id, app_name):
+    def __init__(self, project_id, app_name,
+                 credentials_env='GOOGLE_APPLICATION_CREDENTIALS_BASE64_UNSECURE'):
         # Get encoded Private key of Unsecure project
-        encoded_key = os.getenv(
-            'GOOGLE_APPLICATION_CREDENTIALS_BASE64_UNSECURE')
+        encoded_key = os.getenv(credentials_env)
         decoded_key = base64.b64decode(encoded_key)
         service_account_info = json.loads(decoded_key)
         cred = credentials.Certificate(service_account_info)
 
-        app = firebase_admin.initialize_app(
+        self.app = firebase_admin.initialize_app(
             cred, {'projectId': project_id}, name=app_name)
 
-        self.db = firestore.client(app=app)
+        self.db = firestore.client(app=self.app)
+
+    def close(self):
+        """Close the client and delete the Firebase app of the project"""
+
+        self.db.close()
+        firebase_admin.delete_app(self.app)
 
+    @timed
     def register_user(self, uid):
         """Register a new user"""
 
@@ -29,6 +42,7 @@ class Unsecure:
 
         user_ref.set({'uid': uid, 'balance': 0})
 
+    @timed
     def link_wallet_to_user(self, uid, wallet_number):
         """Link the wallet number to the user in the unsecure project"""
 
@@ -36,6 +50,7 @@ class Unsecure:
 
         user_ref.update({'rented_wallet': wallet_number})
 
+    @timed
     def unlink_wallet_from_user(self, wallet_number):
         """Unlink the wallet from the user in the unsecure project"""
 
@@ -46,14 +61,20 @@ class Unsecure:
 
             # Remove rented wallet
             user.reference.update({'rented_wallet': firestore.DELETE_FIELD})
+            logger.info("Wallet %s unlinked from user", wallet_number,
+                        extra={'event': 'wallet_unlinked', 'wallet_number': wallet_number})
         except IndexError:
-            print(f"No wallet with {wallet_number} number!")
+            logger.warning("No wallet with %s number!", wallet_number,
+                           extra={'event': 'wallet_not_linked', 'wallet_number': wallet_number})
 
+    @timed
     def update_user_balance(self, wallet_number, amount):
         """Update the user's balance based on the wallet deposit"""
 
         if amount < 0:
-            print("The amount is less than 0, it can't be updated.")
+            logger.warning("The amount is less than 0, it can't be updated.",
+                           extra={'event': 'balance_rejected',
+                                  'wallet_number': wallet_number, 'amount': amount})
         else:
             user_ref = self.db.collection('users').where(filter=FieldFilter(
                 'rented_wallet', '==', wallet_number)).limit(1).get()
@@ -65,5 +86,10 @@ class Unsecure:
                 new_balance = user_data['balance'] + amount
 
                 user.reference.update({'balance': new_balance})
+                logger.info("User balance updated by %s", amount,
+                            extra={'event': 'balance_updated',
+                                   'wallet_number': wallet_number, 'amount': amount})
             else:
-                print(f"No user found with wallet {wallet_number}")
+                logger.warning("No user found with wallet %s", wallet_number,
+                               extra={'event': 'balance_user_not_found',
+                                      'wallet_number': wallet_number})
@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+
+logger = logging.getLogger(__name__)
+
+
+class FreeWalletPool:
+    def __init__(self, query):
+        # Query of the unrented wallets, kept in sync by a snapshot listener
+        self.query = query
+
+        self._wallets = {}  # document id -> wallet snapshot
+        self._lock = threading.Lock()
+        self._resync_lock = threading.Lock()
+        self._watch = None
+        self._synced = False
+        self._last_snapshot = None
+        self.read_time = None  # server time of the last snapshot
+        self.resyncs = 0
+
+    def start(self):
+        """Start listening to the unrented wallets"""
+
+        with self._lock:
+            self._synced = False
+        self._watch = self.query.on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        """Stop the listener and drop the mirrored wallets"""
+
+        if self._watch:
+            self._watch.unsubscribe()
+            self._watch = None
+
+        with self._lock:
+            self._wallets.clear()
+            self._synced = False
+
+    def staleness(self):
+        """Seconds since the listener last delivered a snapshot, None before the first one"""
+
+        if self._last_snapshot is None:
+            return None
+        return time.monotonic() - self._last_snapshot
+
+    def is_ready(self):
+        """The mirror has its first snapshot and the listener is still connected"""
+
+        # A quiet pool gets no snapshots, only a closed listener means it is behind
+        return self._synced and self._watch is not None and self._watch.is_active
+
+    def take(self):
+        """Take a wallet that looked unrented in the last snapshot, None if the mirror is not ready"""
+
+        if not self.is_ready():
+            # A dropped listener is restarted, the caller queries meanwhile
+            if self._watch is not None and not self._watch.is_active:
+                self.resync()
+            return None
+
+        with self._lock:
+            if not self._wallets:
+                return None
+
+            # The wallet leaves the mirror so other requests pick another one
+            _, wallet = self._wallets.popitem()
+            return wallet
+
+    def put_back(self, wallet):
+        """Return a taken wallet whose rental did not go through"""
+
+        with self._lock:
+            if self._synced:
+                self._wallets.setdefault(wallet.id, wallet)
+
+    def resync(self):
+        """Restart the listener after a disconnect, the next snapshot rebuilds the mirror"""
+
+        # One request restarts the listener, the others keep using the query
+        if not self._resync_lock.acquire(blocking=False):
+            return
+
+        try:
+            if self.is_ready():
+                return  # Resynchronized since the caller checked
+
+            logger.warning("Free wallet listener disconnected, resynchronizing",
+                           extra={'event': 'wallet_pool_resync'})
+
+            self.stop()
+            self.resyncs += 1
+            self.start()
+        finally:
+            self._resync_lock.release()
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            if not self._synced:
+                # The first snapshot after (re)connecting holds the full result
+                self._wallets = {doc.id: doc for doc in docs}
+                self._synced = True
+            else:
+                for change in changes:
+                    document = change.document
+                    if change.type.name == 'REMOVED':
+                        self._wallets.pop(document.id, None)
+                    else:
+                        self._wallets[document.id] = document
+
+            self._last_snapshot = time.monotonic()
+            self.read_time = read_time
+
+
+class InMemoryWalletQuery:
+    def __init__(self, wallets=()):
+        # Stand-in of the Firestore query for tests, wallets are snapshots
+        self.wallets = {wallet.id: wallet for wallet in wallets}
+        self.watches = []
+
+    def on_snapshot(self, callback):
+        watch = InMemoryWatch(callback)
+        self.watches.append(watch)
+        callback(list(self.wallets.values()), [], None)
+        return watch
+
+    def push(self, wallet, change_type):
+        """Send an ADDED, MODIFIED or REMOVED change to the active listeners"""
+
+        if change_type == 'REMOVED':
+            self.wallets.pop(wallet.id, None)
+        else:
+            self.wallets[wallet.id] = wallet
+
+        change = InMemoryChange(change_type, wallet)
+        for watch in self.watches:
+            if watch.is_active:
+                watch.callback(list(self.wallets.values()), [change], None)
+
+
+class InMemoryWatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+
+
+class InMemoryChange:
+    def __init__(self, change_type, document):
+        self.type = SimpleNamespace(name=change_type)
+        self.document = document
@@ -1,31 +1,39 @@
 import functions_framework
 import json
+import logging
 
 
-from projects.unsecure_project import Unsecure
-from projects.secure_project import Secure
+from projects.bootstrap import create_profiler, create_registry, setup_logging
+from projects.structured_logging import set_request_id
 
 
-# Initialize Firestore DB and Pub/Sub
-secure_project_id = "xenon-sunspot-429207-s0"
-unsecure_project_id = "nifty-kayak-435509-d6"
-secure_app_name = "secure_app"
-unsecure_app_name = "unsecure_app"
+setup_logging()
 
-# Initialize both projects
-unsecure_db = Unsecure(unsecure_project_id, unsecure_app_name)
-secure_db = Secure(secure_project_id, secure_app_name, unsecure_db)
+registry = create_registry()
+
+profiler = create_profiler()
+
+logger = logging.getLogger(__name__)
 
 
 @functions_framework.http
+@profiler.profile
 def register_user(request):
+    set_request_id(request)
+    try:
+        tenant_id = registry.resolve(request)
+    except ValueError as e:
+        response = {"status": "error", "message": str(e)}
+        return (json.dumps(response), 400, {'Content-Type': 'application/json'})
+
     try:
         # Parse request body for uid
         request_json = request.get_json()
         uid = request_json['uid']  # Extract the 'uid' parameter
 
         # Register the user in the unsecure system
-        unsecure_db.register_user(uid)
+        with registry.use(tenant_id) as (_, unsecure_db):
+            unsecure_db.register_user(uid)
 
         # Return success response
         response = {
@@ -45,6 +53,8 @@ def register_user(request):
         return (json.dumps(response), 400, {'Content-Type': 'application/json'})
 
     except Exception as e:
+        logger.exception("User registration failed: %s", e, extra={'event': 'register_failed'})
+
         # Handle any other errors
         response = {
             "status": "error",
@@ -1,68 +1,108 @@
 import functions_framework
-import threading
-import time
-from firebase_admin import firestore
-from google.cloud.firestore_v1.base_query import FieldFilter
+import functools
+import logging
+import os
+from datetime import datetime, timezone
 
 
-from projects.unsecure_project import Unsecure
-from projects.secure_project import Secure
+from projects.secure_project import RENTAL_PERIOD
+from projects.tenants import DEFAULT_TENANT, SECURE_PROJECT_ID
+from projects.expiry_queue import CloudTasksExpiryQueue
+from projects.bootstrap import create_analytics, create_profiler, create_registry, setup_logging
+from projects.structured_logging import set_request_id
 
 
-# Initialize Firestore DB and Pub/Sub
-secure_project_id = "xenon-sunspot-429207-s0"
-unsecure_project_id = "nifty-kayak-435509-d6"
-secure_app_name = "secure_app"
-unsecure_app_name = "unsecure_app"
+setup_logging()
 
-# Initialize both projects
-unsecure_db = Unsecure(unsecure_project_id, unsecure_app_name)
-secure_db = Secure(secure_project_id, secure_app_name, unsecure_db)
+registry = create_registry(
+    analytics=create_analytics(),
+    mirror_wallets=os.getenv('MIRROR_FREE_WALLETS') == '1')
+
+profiler = create_profiler()
+
+logger = logging.getLogger(__name__)
+
+# Tries to queue the expiry before the rental is undone
+SCHEDULE_ATTEMPTS = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_expiry_queue():
+    """Cloud Tasks queue that calls expire_wallet when a rental ends"""
+
+    # Built on the first rental, expire_wallet is deployed without these variables
+    return CloudTasksExpiryQueue(
+        SECURE_PROJECT_ID,
+        os.getenv('EXPIRY_TASKS_LOCATION', 'us-central1'),
+        os.getenv('EXPIRY_TASKS_QUEUE', 'wallet-expiry'),
+        os.getenv('EXPIRY_HANDLER_URL'),
+        os.getenv('EXPIRY_TASKS_SERVICE_ACCOUNT'),
+    )
 
 
 @functions_framework.http
+@profiler.profile
 def rent_wallet(request):
     """HTTP function to rent a wallet for a user for 5 minutes"""
+    set_request_id(request)
     request_json = request.get_json(silent=True)
     uid = request_json.get('uid')
 
     if not uid:
         return {'status': 'failed', 'message': 'UID is required'}, 400
 
-    # Rent a wallet from the secure project
-    wallet_number = secure_db.rent_wallet(uid)
-
-    # Start a thread to expire the wallet after 5 minutes
-    thread = threading.Thread(
-        target=expire_wallet_after_timeout, args=(uid, wallet_number, 5))
-    thread.start()
+    try:
+        tenant_id = registry.resolve(request)
+    except ValueError as e:
+        return {'status': 'failed', 'message': str(e)}, 400
+
+    # Fails before renting if the queue is not configured
+    expiry_queue = get_expiry_queue()
+
+    # Rent a wallet from the secure project, held open until the expiry is scheduled
+    with registry.use(tenant_id) as (secure_db, _):
+        wallet_number = secure_db.rent_wallet(uid)
+
+        # Schedule the wallet expiry at the end of the rental period
+        rental_expiry = datetime.now(timezone.utc) + RENTAL_PERIOD
+        for attempt in range(1, SCHEDULE_ATTEMPTS + 1):
+            try:
+                expiry_queue.schedule(uid, wallet_number, rental_expiry, tenant_id)
+                break
+            except Exception as e:
+                logger.exception("Failed to schedule expiry of wallet %s: %s", wallet_number, e,
+                                 extra={'event': 'expiry_schedule_failed', 'uid': uid,
+                                        'wallet_number': wallet_number, 'attempt': attempt})
+        else:
+            # Without an expiry task the wallet would stay rented forever
+            secure_db.expire_wallet(uid, wallet_number, force=True)
+            return {'status': 'failed', 'message': 'Could not schedule the wallet expiry'}, 503
 
     return {'status': 'success', 'walletNumber': wallet_number}, 200
 
 
-def expire_wallet_after_timeout(uid, wallet_number, timeout_minutes):
-    """Expire the wallet after a timeout"""
-    # Wait for the rental period to expire (5 minutes in this case)
-    time.sleep(timeout_minutes * 60)
+@functions_framework.http
+@profiler.profile
+def expire_wallet(request):
+    """HTTP function called by Cloud Tasks when a wallet rental ends"""
+    set_request_id(request)
+    request_json = request.get_json(silent=True) or {}
+    uid = request_json.get('uid')
+    wallet_number = request_json.get('wallet_number')
+    tenant_id = request_json.get('tenant_id') or DEFAULT_TENANT
+
+    if not uid or wallet_number is None:
+        return {'status': 'failed', 'message': 'UID and wallet number are required'}, 400
 
-    # Check if the wallet still exists and hasn't already been updated
-    wallet_query = secure_db.db.collection('wallets').where(
-        filter=FieldFilter('number', '==', wallet_number)).limit(1).stream()
-    wallet = next(wallet_query, None)
+    if tenant_id not in registry.tenants:
+        return {'status': 'failed', 'message': f"Unknown tenant {tenant_id}"}, 400
 
-    if wallet:
-        wallet_data = wallet.to_dict()
+    expire_wallet_after_timeout(uid, wallet_number, tenant_id)
 
-        # Check if the wallet is still rented and if the rental has expired
-        if wallet_data.get('is_rented', False):
-            wallet_ref = wallet.reference
-            wallet_ref.update({'is_rented': False})  # Expire the wallet
+    return {'status': 'success', 'walletNumber': wallet_number}, 200
 
-            # Unlink the wallet from the user in the unsecure project
-            user_ref = unsecure_db.db.collection('users').document(uid)
-            # Remove rented wallet
-            user_ref.update({'rented_wallet': firestore.DELETE_FIELD})
 
-            print(f"Wallet {wallet_number} expired for user {uid}")
-        else:
-            print(f"Wallet {wallet_number} already expired for user {uid}")
+def expire_wallet_after_timeout(uid, wallet_number, tenant_id=DEFAULT_TENANT):
+    """Expire the wallet once its rental period is over"""
+    with registry.use(tenant_id) as (secure_db, _):
+        return secure_db.expire_wallet(uid, wallet_number)
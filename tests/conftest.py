@@ -23,6 +23,12 @@ def mock_unsecure():
     return mock.MagicMock()
 
 
+@pytest.fixture
+def mock_analytics():
+    """Mock analytics exporter passed to Secure."""
+    return mock.MagicMock()
+
+
 @pytest.fixture
 def mock_firebase_init():
     """Mock firebase_admin.initialize_app to avoid reinitializing Firebase."""
@@ -38,11 +44,12 @@ def mock_firebase_credentials():
 
 
 @pytest.fixture
-def secure_class(mock_firestore, mock_pubsub, mock_unsecure, mock_firebase_init, mock_firebase_credentials):
+def secure_class(mock_firestore, mock_pubsub, mock_unsecure, mock_analytics, mock_firebase_init, mock_firebase_credentials):
     """Fixture for the Secure class."""
     with mock.patch('firebase_admin.firestore.client', return_value=mock_firestore):
         with mock.patch('google.cloud.pubsub_v1.PublisherClient', return_value=mock_pubsub):
-            yield Secure(project_id='secure_project', app_name='secure_app_test', unsecure_db=mock_unsecure)
+            yield Secure(project_id='secure_project', app_name='secure_app_test', unsecure_db=mock_unsecure, analytics=mock_analytics,
+                         tenant_id='tenant_a')
 
 
 @pytest.fixture
@@ -0,0 +1,184 @@
+import itertools
+import threading
+import uuid
+from collections import Counter
+
+from firebase_admin import firestore
+from google.api_core import exceptions
+
+from projects.wallet_pool import InMemoryWatch
+
+
+class CountingFirestore:
+    """In-memory Firestore client that counts the RPCs of every operation"""
+
+    def __init__(self):
+        self.collections = {}  # collection -> document id -> data
+        self.update_times = {}  # (collection, document id) -> update time
+        self.counts = Counter()
+
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return CountingCollection(self, name)
+
+    def write_option(self, last_update_time):
+        return {'last_update_time': last_update_time}
+
+    def close(self):
+        pass
+
+    def reset_counts(self):
+        self.counts = Counter()
+
+    def count(self, **counts):
+        # Fan out threads call the client at the same time
+        with self._lock:
+            self.counts.update(counts)
+
+    def seed(self, collection, document_id, data):
+        """Add a document without counting it"""
+
+        self.collections.setdefault(collection, {})[document_id] = dict(data)
+        self.update_times[(collection, document_id)] = next(self._clock)
+
+    def write(self, collection, document_id, data, merge, option=None):
+        key = (collection, document_id)
+        documents = self.collections.setdefault(collection, {})
+
+        with self._lock:
+            if option and self.update_times.get(key) != option['last_update_time']:
+                raise exceptions.FailedPrecondition('document was changed')
+            if merge and document_id not in documents:
+                raise exceptions.NotFound('document does not exist')
+
+            new_data = dict(documents.get(document_id, {})) if merge else {}
+            for field, value in data.items():
+                if value is firestore.DELETE_FIELD:
+                    new_data.pop(field, None)
+                else:
+                    new_data[field] = value
+
+            documents[document_id] = new_data
+            self.update_times[key] = next(self._clock)
+            self.counts['writes'] += 1
+
+    def snapshot(self, collection, document_id):
+        data = self.collections.get(collection, {}).get(document_id)
+        return CountingSnapshot(
+            CountingDocument(self, collection, document_id), data,
+            self.update_times.get((collection, document_id)))
+
+
+class CountingCollection:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def document(self, document_id=None):
+        return CountingDocument(self.client, self.name, document_id or uuid.uuid4().hex)
+
+    def where(self, filter):
+        return CountingQuery(self.client, self.name, [filter])
+
+
+class CountingDocument:
+    def __init__(self, client, collection, document_id):
+        self.client = client
+        self.collection = collection
+        self.id = document_id
+
+    def get(self, transaction=None):
+        self.client.count(reads=1)
+        return self.client.snapshot(self.collection, self.id)
+
+    def set(self, data):
+        self.client.write(self.collection, self.id, data, merge=False)
+
+    def update(self, data, option=None):
+        self.client.write(self.collection, self.id, data, merge=True, option=option)
+
+
+class CountingSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = dict(data) if data is not None else None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+
+class CountingQuery:
+    OPERATORS = {
+        '==': lambda value, expected: value == expected,
+        '<': lambda value, expected: value is not None and value < expected,
+    }
+
+    def __init__(self, client, collection, filters, limit=None, order_by=None, start_after=None):
+        self.client = client
+        self.collection = collection
+        self.filters = filters
+        self._limit = limit
+        self._order_by = order_by
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        options = {'filters': self.filters, 'limit': self._limit, 'order_by': self._order_by,
+                   'start_after': self._start_after, **changes}
+        return CountingQuery(self.client, self.collection, **options)
+
+    def where(self, filter):
+        return self._copy(filters=self.filters + [filter])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def order_by(self, field):
+        return self._copy(order_by=field)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot)
+
+    def _sort_key(self, document_id):
+        # Firestore orders by the field, then by the document id
+        data = self.client.collections[self.collection][document_id]
+        return (data.get(self._order_by), document_id)
+
+    def _matches(self):
+        documents = self.client.collections.get(self.collection, {})
+        matches = [
+            document_id for document_id, data in documents.items()
+            if all(self.OPERATORS[f.op_string](data.get(f.field_path), f.value)
+                   for f in self.filters)
+        ]
+        if self._order_by:
+            matches.sort(key=self._sort_key)
+            if self._start_after:
+                cursor = (self._start_after.get(self._order_by), self._start_after.id)
+                matches = [document_id for document_id in matches
+                           if self._sort_key(document_id) > cursor]
+        return [self.client.snapshot(self.collection, document_id)
+                for document_id in matches[:self._limit]]
+
+    def get(self):
+        snapshots = self._matches()
+        # A query is billed at least one read even if it returns nothing
+        self.client.count(queries=1, documents_scanned=max(len(snapshots), 1))
+        return snapshots
+
+    def stream(self):
+        return iter(self.get())
+
+    def on_snapshot(self, callback):
+        # The listener is charged for the documents of its first snapshot
+        snapshots = self._matches()
+        self.client.count(listeners=1, documents_scanned=len(snapshots))
+        callback(snapshots, [], None)
+        return InMemoryWatch(callback)
@@ -0,0 +1,206 @@
+"""Firestore RPC counts of every Secure/Unsecure operation against their budgets.
+
+Print the report:           python -m tests.rpc_budget
+Accept the current counts:  python -m tests.rpc_budget --update
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from projects.archive import WalletArchiver
+from projects.unsecure_project import Unsecure
+from projects.secure_project import Secure
+from tests.counting_firestore import CountingFirestore
+
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), 'rpc_budgets.json')
+
+METRICS = ['reads', 'queries', 'documents_scanned', 'writes', 'listeners']
+
+
+class MemoryArchiveStore:
+    """Archive store that keeps the chunks in memory"""
+
+    def __init__(self):
+        self.chunks = {}
+
+    def write(self, chunk_name, data):
+        self.chunks[chunk_name] = data
+
+    def read(self, chunk_name):
+        return self.chunks[chunk_name]
+
+
+# Chunk names are unique, every operation can share the store
+ARCHIVE_STORE = MemoryArchiveStore()
+
+
+def seed_user(unsecure_fs, wallet_number=None):
+    user = {'uid': 'user_1', 'balance': 0}
+    if wallet_number is not None:
+        user['rented_wallet'] = wallet_number
+    unsecure_fs.seed('users', 'user_1', user)
+
+
+def seed_wallet(secure_fs, is_rented, rental_expiry=None):
+    secure_fs.seed('wallets', 'wallet_1', {
+        'wallet_uid': 'wallet_1',
+        'number': 1,
+        'balance': 0,
+        'is_rented': is_rented,
+        'rental_expiry': rental_expiry or datetime.now(timezone.utc) + timedelta(minutes=5)
+    })
+
+
+def setup_free_wallet(secure_fs, unsecure_fs):
+    seed_user(unsecure_fs)
+    seed_wallet(secure_fs, is_rented=False)
+
+
+def setup_rented_wallet(secure_fs, unsecure_fs):
+    seed_user(unsecure_fs, wallet_number=1)
+    seed_wallet(secure_fs, is_rented=True)
+
+
+def setup_expired_wallet(secure_fs, unsecure_fs):
+    seed_user(unsecure_fs, wallet_number=1)
+    seed_wallet(secure_fs, is_rented=True,
+                rental_expiry=datetime.now(timezone.utc) - timedelta(minutes=5))
+
+
+def setup_archived_wallet(secure_fs, unsecure_fs):
+    seed_wallet(secure_fs, is_rented=False,
+                rental_expiry=datetime.now(timezone.utc) - timedelta(days=100))
+    WalletArchiver(secure_fs, ARCHIVE_STORE).archive_idle_wallets()
+
+
+def restart_wallet_mirror(secure_db):
+    # The listener reads every unrented wallet when it (re)starts
+    secure_db.wallet_pool.stop()
+    secure_db.wallet_pool.start()
+
+
+# Operation -> (seed the projects, run the operation, mirror free wallets)
+OPERATIONS = {
+    'register_user': (
+        lambda secure_fs, unsecure_fs: None,
+        lambda secure_db: secure_db.unsecure_db.register_user('user_1'),
+        False),
+    'rent_wallet_free_wallet': (
+        setup_free_wallet,
+        lambda secure_db: secure_db.rent_wallet('user_1'),
+        False),
+    'rent_wallet_new_wallet': (
+        lambda secure_fs, unsecure_fs: seed_user(unsecure_fs),
+        lambda secure_db: secure_db.rent_wallet('user_1'),
+        False),
+    'rent_wallet_mirror': (
+        setup_free_wallet,
+        lambda secure_db: secure_db.rent_wallet('user_1'),
+        True),
+    'wallet_mirror_start': (
+        setup_free_wallet,
+        restart_wallet_mirror,
+        True),
+    'deposit_within_rental': (
+        setup_rented_wallet,
+        lambda secure_db: secure_db.deposit_to_wallet(1, 100),
+        False),
+    'deposit_after_expiry': (
+        setup_expired_wallet,
+        lambda secure_db: secure_db.deposit_to_wallet(1, 100),
+        False),
+    'deposit_archived_wallet': (
+        setup_archived_wallet,
+        lambda secure_db: secure_db.deposit_to_wallet(1, 100),
+        False),
+    'expire_wallet': (
+        setup_expired_wallet,
+        lambda secure_db: secure_db.expire_wallet('user_1', 1),
+        False),
+    'deposit_negative_amount': (
+        setup_rented_wallet,
+        lambda secure_db: secure_db.deposit_to_wallet(1, -100),
+        False),
+}
+
+
+def measure(operation):
+    """Run the operation against counting projects and return its RPC counts"""
+
+    setup, run, mirror_wallets = OPERATIONS[operation]
+    secure_fs, unsecure_fs = CountingFirestore(), CountingFirestore()
+    setup(secure_fs, unsecure_fs)
+
+    credentials = {
+        'GOOGLE_APPLICATION_CREDENTIALS_BASE64_SECURE': 'e30=',
+        'GOOGLE_APPLICATION_CREDENTIALS_BASE64_UNSECURE': 'e30=',
+    }
+    with mock.patch.dict(os.environ, credentials), \
+            mock.patch('firebase_admin.initialize_app'), \
+            mock.patch('firebase_admin.credentials.Certificate'), \
+            mock.patch('google.cloud.pubsub_v1.PublisherClient'), \
+            mock.patch('firebase_admin.firestore.client', side_effect=[unsecure_fs, secure_fs]):
+        unsecure_db = Unsecure('unsecure_project', 'unsecure_app')
+        secure_db = Secure('secure_project', 'secure_app', unsecure_db,
+                           mirror_wallets=mirror_wallets, archive_store=ARCHIVE_STORE)
+
+    # Only the operation is counted, not the seeding or the project setup
+    secure_fs.reset_counts()
+    unsecure_fs.reset_counts()
+    run(secure_db)
+
+    counts = secure_fs.counts + unsecure_fs.counts
+    return {metric: counts[metric] for metric in METRICS}
+
+
+def load_budgets():
+    with open(BUDGETS_PATH, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def report(budgets, results):
+    """Format the counts next to the budgets, return the text and the operations over budget"""
+
+    lines = [f"{'operation':<26}{'metric':<20}{'budget':>8}{'actual':>8}{'delta':>8}"]
+    over_budget = []
+
+    for operation, counts in results.items():
+        budget = budgets.get(operation, {})
+        for metric in METRICS:
+            limit = budget.get(metric, 0)
+            actual = counts[metric]
+            if not limit and not actual:
+                continue
+
+            delta = actual - limit
+            flag = '  OVER' if delta > 0 else ''
+            lines.append(
+                f"{operation:<26}{metric:<20}{limit:>8}{actual:>8}{delta:>+8}{flag}")
+
+            if delta > 0:
+                over_budget.append(operation)
+
+    return '\n'.join(lines), over_budget
+
+
+def main(argv):
+    results = {operation: measure(operation) for operation in OPERATIONS}
+
+    if '--update' in argv:
+        with open(BUDGETS_PATH, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+            file.write('\n')
+        print(f"Budgets written to {BUDGETS_PATH}")
+        return 0
+
+    text, over_budget = report(load_budgets(), results)
+    print(text)
+
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,125 @@
+import json
+import time
+from unittest import mock
+
+import pytest
+
+from datetime import datetime, timezone
+
+from projects.analytics import AnalyticsExporter, BigQuerySink, NdjsonSink
+
+
+@pytest.fixture
+def mock_sink():
+    """Mock analytics sink."""
+    return mock.MagicMock()
+
+
+def test_exporter_flushes_full_batch(mock_sink):
+    exporter = AnalyticsExporter(
+        mock_sink, max_batch_size=3, max_interval_seconds=3600)
+
+    exporter.record('rental', uid='user_1', wallet_number=1)
+    exporter.record('deposit', wallet_number=1, amount=10)
+    exporter.flush()
+    mock_sink.write.assert_called_once()
+
+    for number in range(3):
+        exporter.record('rental', uid='user_1', wallet_number=number)
+
+    # The full batch is written without an explicit flush
+    exporter.close()
+    assert mock_sink.write.call_count == 2
+    assert len(mock_sink.write.call_args.args[0]) == 3
+
+
+def test_exporter_flushes_after_interval(mock_sink):
+    exporter = AnalyticsExporter(
+        mock_sink, max_batch_size=500, max_interval_seconds=0)
+
+    exporter.record('deposit', wallet_number=1, amount=10)
+    exporter.close()
+
+    batch = mock_sink.write.call_args.args[0]
+    assert batch[0]['event_type'] == 'deposit'
+    assert batch[0]['amount'] == 10
+
+
+def test_exporter_flushes_on_timer_without_new_events(mock_sink):
+    exporter = AnalyticsExporter(
+        mock_sink, max_batch_size=500, max_interval_seconds=0.2)
+
+    exporter.record('deposit', wallet_number=1, amount=10)
+    time.sleep(0.6)
+
+    # The timer wrote the batch, no record() or flush() was needed
+    mock_sink.write.assert_called_once()
+    exporter.close()
+
+
+def test_exporter_record_after_close(mock_sink):
+    exporter = AnalyticsExporter(mock_sink)
+    exporter.close()
+
+    exporter.record('deposit', wallet_number=1, amount=10)
+
+    mock_sink.write.assert_not_called()
+
+
+def test_exporter_sink_error_does_not_raise(mock_sink, caplog):
+    mock_sink.write.side_effect = RuntimeError('sink is down')
+    exporter = AnalyticsExporter(mock_sink, max_batch_size=1)
+
+    exporter.record('deposit', wallet_number=1, amount=10)
+    exporter.close()
+
+    mock_sink.write.assert_called_once()
+    # The traceback of the sink error is logged
+    record, = [r for r in caplog.records if r.event == 'analytics_export_failed']
+    assert record.getMessage() == "Failed to export 1 analytics events: sink is down"
+    assert record.exc_info[0] is RuntimeError
+
+
+def test_ndjson_sink_writes_file_per_event_type(tmp_path):
+    sink = NdjsonSink(str(tmp_path))
+    created_at = datetime(2024, 9, 1, tzinfo=timezone.utc)
+
+    sink.write([
+        {'event_type': 'rental', 'uid': 'user_1', 'wallet_number': 1,
+         'created_at': created_at},
+        {'event_type': 'deposit', 'wallet_number': 1, 'amount': 10},
+    ])
+    sink.write([{'event_type': 'deposit', 'wallet_number': 2, 'amount': 5}])
+
+    rentals = (tmp_path / 'rental.ndjson').read_text().splitlines()
+    deposits = (tmp_path / 'deposit.ndjson').read_text().splitlines()
+
+    assert json.loads(rentals[0])['created_at'] == created_at.isoformat()
+    assert [json.loads(row)['amount'] for row in deposits] == [10, 5]
+
+
+@pytest.mark.parametrize("use_load_job", [False, True])
+def test_bigquery_sink(use_load_job):
+    client = mock.MagicMock()
+    client.insert_rows_json.return_value = []
+    sink = BigQuerySink('project.dataset.events',
+                        use_load_job=use_load_job, client=client)
+
+    sink.write([{'event_type': 'deposit', 'wallet_number': 1, 'amount': 10}])
+
+    rows = [{'event_type': 'deposit', 'wallet_number': 1, 'amount': 10}]
+    if use_load_job:
+        client.load_table_from_json.assert_called_once_with(
+            rows, 'project.dataset.events')
+    else:
+        client.insert_rows_json.assert_called_once_with(
+            'project.dataset.events', rows)
+
+
+def test_bigquery_sink_insert_errors():
+    client = mock.MagicMock()
+    client.insert_rows_json.return_value = [{'index': 0, 'errors': ['bad']}]
+    sink = BigQuerySink('project.dataset.events', client=client)
+
+    with pytest.raises(RuntimeError, match="BigQuery insert errors"):
+        sink.write([{'event_type': 'deposit'}])
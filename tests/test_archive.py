@@ -0,0 +1,126 @@
+import gzip
+import json
+from unittest import mock
+
+import pytest
+
+from datetime import datetime, timedelta, timezone
+
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from projects.archive import LocalArchiveStore, StorageArchiveStore, WalletArchiver
+from tests.counting_firestore import CountingFirestore
+
+
+NOW = datetime(2024, 9, 1, tzinfo=timezone.utc)
+
+
+def seed_wallet(db, wallet_id, number, is_rented, idle_days):
+    db.seed('wallets', wallet_id, {
+        'wallet_uid': wallet_id,
+        'number': number,
+        'balance': 50,
+        'is_rented': is_rented,
+        'rental_expiry': NOW - timedelta(days=idle_days)
+    })
+
+
+@pytest.fixture
+def db():
+    """Counting Firestore with idle, recent and rented wallets."""
+    db = CountingFirestore()
+    seed_wallet(db, 'idle_1', 1, False, 100)
+    seed_wallet(db, 'idle_2', 2, False, 200)
+    seed_wallet(db, 'recent', 3, False, 10)
+    seed_wallet(db, 'rented', 4, True, 100)
+    return db
+
+
+@pytest.fixture
+def archiver(db, tmp_path):
+    """Fixture for the WalletArchiver class."""
+    return WalletArchiver(db, LocalArchiveStore(str(tmp_path)), idle_days=90, chunk_size=1)
+
+
+def test_archive_idle_wallets(archiver, db, tmp_path):
+    assert archiver.archive_idle_wallets(NOW) == 2
+
+    tombstone = db.collections['wallets']['idle_1']
+    assert tombstone == {
+        'wallet_uid': 'idle_1',
+        'number': 1,
+        'archived': True,
+        'archive_chunk': tombstone['archive_chunk'],
+    }
+    assert db.collections['wallets']['recent']['balance'] == 50
+    assert db.collections['wallets']['rented']['is_rented'] is True
+
+    # chunk_size=1 writes one chunk per wallet
+    chunk = gzip.decompress((tmp_path / tombstone['archive_chunk']).read_bytes())
+    record = json.loads(chunk)
+    assert record['id'] == 'idle_1'
+    assert record['data']['rental_expiry'] == {
+        '__datetime__': (NOW - timedelta(days=100)).isoformat()}
+    assert len(list(tmp_path.glob('*.ndjson.gz'))) == 2
+
+
+def test_archive_skips_wallet_rented_meanwhile(archiver, db):
+    wallets = db.collection('wallets').where(
+        filter=FieldFilter('number', '==', 1)).get()
+
+    # The wallet was rented after the archive job read it
+    db.collection('wallets').document('idle_1').update({'is_rented': True})
+
+    assert archiver._archive_chunk(wallets, NOW) == 0
+    assert db.collections['wallets']['idle_1']['balance'] == 50
+
+
+def test_rehydrate(archiver, db):
+    archiver.archive_idle_wallets(NOW)
+    tombstone = db.collection('wallets').document('idle_2').get()
+
+    wallet = archiver.rehydrate(tombstone)
+
+    assert wallet.to_dict() == {
+        'wallet_uid': 'idle_2',
+        'number': 2,
+        'balance': 50,
+        'is_rented': False,
+        'rental_expiry': NOW - timedelta(days=200)
+    }
+
+
+def test_archive_skips_wallets_with_recent_deposits(archiver, db):
+    # idle_2 comes first in the query, it got a deposit after its rental ended
+    db.collection('wallets').document('idle_2').update({'last_activity': NOW - timedelta(days=1)})
+
+    assert archiver.archive_idle_wallets(NOW) == 1
+
+    assert db.collections['wallets']['idle_1']['archived'] is True
+    assert db.collections['wallets']['idle_2']['balance'] == 50
+
+
+def test_rehydrate_keeps_fields_written_to_tombstone(archiver, db):
+    archiver.archive_idle_wallets(NOW)
+    # A write that raced the archive job landed on the tombstone
+    db.collection('wallets').document('idle_2').update({'balance': 150})
+    tombstone = db.collection('wallets').document('idle_2').get()
+
+    wallet = archiver.rehydrate(tombstone)
+
+    assert wallet.to_dict()['balance'] == 150
+    assert 'archived' not in wallet.to_dict()
+
+
+def test_storage_store():
+    client = mock.MagicMock()
+    store = StorageArchiveStore('archive_bucket', client=client)
+
+    store.write('wallets-1.ndjson.gz', b'data')
+    store.read('wallets-1.ndjson.gz')
+
+    blob = client.bucket.return_value.blob
+    blob.assert_called_with('wallet-archive/wallets-1.ndjson.gz')
+    blob.return_value.upload_from_string.assert_called_once_with(
+        b'data', content_type='application/gzip')
+    blob.return_value.download_as_bytes.assert_called_once()
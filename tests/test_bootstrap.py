@@ -0,0 +1,36 @@
+import os
+from unittest import mock
+
+from projects.archive import LocalArchiveStore
+from projects.bootstrap import create_analytics, create_archive_store, create_registry
+from projects.tenants import DEFAULT_TENANT
+
+
+def test_optional_services_off_by_default():
+    with mock.patch.dict(os.environ, clear=True):
+        assert create_analytics() is None
+        assert create_archive_store() is None
+
+
+def test_create_archive_store_local(tmp_path):
+    with mock.patch.dict(os.environ, {'ARCHIVE_DIR': str(tmp_path)}, clear=True):
+        store = create_archive_store()
+
+    assert isinstance(store, LocalArchiveStore)
+    assert store.directory == str(tmp_path)
+
+
+def test_create_registry_initializes_default_tenant():
+    with mock.patch('projects.bootstrap.TenantRegistry') as mock_registry:
+        registry = create_registry(mirror_wallets=True)
+
+    assert registry is mock_registry.return_value
+    assert mock_registry.call_args.kwargs == {'mirror_wallets': True}
+    registry.get.assert_called_once_with(DEFAULT_TENANT)
+
+
+def test_create_registry_without_default_tenant():
+    with mock.patch('projects.bootstrap.TenantRegistry') as mock_registry:
+        create_registry(initialize_default=False)
+
+    mock_registry.return_value.get.assert_not_called()
@@ -0,0 +1,136 @@
+from unittest import mock
+
+import pytest
+
+from datetime import datetime, timedelta, timezone
+
+from google.api_core import exceptions
+
+from projects.expiry_queue import CloudTasksExpiryQueue, LocalExpiryQueue, expiry_task_id
+
+
+NOW = datetime(2024, 9, 1, 12, 0, tzinfo=timezone.utc)
+
+
+# Tests for LocalExpiryQueue
+
+def test_local_queue_runs_due_tasks_in_order():
+    handler = mock.MagicMock()
+    queue = LocalExpiryQueue(handler)
+
+    queue.schedule('user_2', 2, NOW + timedelta(minutes=2))
+    queue.schedule('user_1', 1, NOW + timedelta(minutes=1))
+    queue.schedule('user_3', 3, NOW + timedelta(minutes=10))
+
+    assert queue.run_due(NOW) == 0
+    assert queue.run_due(NOW + timedelta(minutes=5)) == 2
+
+    assert handler.call_args_list == [
+        mock.call('user_1', 1, None), mock.call('user_2', 2, None)]
+    assert len(queue) == 1
+
+
+def test_local_queue_deduplicates_by_wallet_number():
+    handler = mock.MagicMock()
+    queue = LocalExpiryQueue(handler)
+
+    assert queue.schedule('user_1', 1, NOW) is True
+    assert queue.schedule('user_1', 1, NOW) is False
+
+    # The wallet was rented again, only the newer rental should expire it
+    queue.schedule('user_2', 1, NOW + timedelta(minutes=5))
+
+    assert queue.run_due(NOW) == 0
+    assert queue.run_due(NOW + timedelta(minutes=5)) == 1
+    handler.assert_called_once_with('user_2', 1, None)
+
+
+def test_local_queue_many_outstanding_tasks():
+    handler = mock.MagicMock()
+    queue = LocalExpiryQueue(handler)
+
+    for number in range(5000):
+        queue.schedule(f"user_{number}", number,
+                       NOW + timedelta(seconds=number))
+
+    assert len(queue) == 5000
+    assert queue.run_due(NOW + timedelta(seconds=2499)) == 2500
+    assert len(queue) == 2500
+
+
+# Tests for CloudTasksExpiryQueue
+
+@pytest.fixture
+def mock_tasks_client():
+    """Mock Cloud Tasks client."""
+    client = mock.MagicMock()
+    client.queue_path.return_value = 'queue_path'
+    client.task_path.side_effect = lambda project, location, queue, task: task
+    return client
+
+
+@pytest.fixture
+def cloud_queue(mock_tasks_client):
+    """Fixture for the CloudTasksExpiryQueue class."""
+    return CloudTasksExpiryQueue('secure_project', 'us-central1', 'wallet-expiry',
+                                 'https://example.com/expire_wallet',
+                                 'expiry@secure_project.iam.gserviceaccount.com',
+                                 client=mock_tasks_client)
+
+
+def test_cloud_queue_schedule(cloud_queue, mock_tasks_client):
+    assert cloud_queue.schedule('user_1', 7, NOW) is True
+
+    mock_tasks_client.queue_path.assert_called_once_with(
+        'secure_project', 'us-central1', 'wallet-expiry')
+    task = mock_tasks_client.create_task.call_args.kwargs['task']
+
+    assert task.name == expiry_task_id(7, NOW)
+    assert task.schedule_time == NOW
+    assert task.http_request.url == 'https://example.com/expire_wallet'
+    assert task.http_request.body == b'{"uid": "user_1", "wallet_number": 7, "tenant_id": null}'
+    assert task.http_request.oidc_token.service_account_email == \
+        'expiry@secure_project.iam.gserviceaccount.com'
+
+
+def test_cloud_queue_requires_handler_url(mock_tasks_client):
+    with pytest.raises(ValueError, match="EXPIRY_HANDLER_URL is not set."):
+        CloudTasksExpiryQueue('secure_project', 'us-central1', 'wallet-expiry',
+                              None, 'expiry@secure_project.iam.gserviceaccount.com',
+                              client=mock_tasks_client)
+
+
+def test_cloud_queue_requires_service_account(mock_tasks_client):
+    with pytest.raises(ValueError, match="EXPIRY_TASKS_SERVICE_ACCOUNT is not set."):
+        CloudTasksExpiryQueue('secure_project', 'us-central1', 'wallet-expiry',
+                              'https://example.com/expire_wallet', None,
+                              client=mock_tasks_client)
+
+
+def test_cloud_queue_schedule_already_exists(cloud_queue, mock_tasks_client):
+    mock_tasks_client.create_task.side_effect = exceptions.AlreadyExists(
+        'task exists')
+
+    assert cloud_queue.schedule('user_1', 7, NOW) is False
+
+
+@pytest.mark.parametrize("wallet_number, task_id", [
+    (1, 'wallet-1-1725192000'),
+    (2.5, 'wallet-2_5-1725192000'),
+    (-10, 'wallet-m10-1725192000'),
+])
+def test_expiry_task_id(wallet_number, task_id):
+    assert expiry_task_id(wallet_number, NOW) == task_id
+    assert expiry_task_id(wallet_number, NOW, 'tenant_a') == f"tenant_a-{task_id}"
+
+
+def test_local_queue_keeps_tenants_apart():
+    handler = mock.MagicMock()
+    queue = LocalExpiryQueue(handler)
+
+    queue.schedule('user_1', 1, NOW, 'tenant_a')
+    queue.schedule('user_2', 1, NOW, 'tenant_b')
+
+    assert queue.run_due(NOW) == 2
+    handler.assert_any_call('user_1', 1, 'tenant_a')
+    handler.assert_any_call('user_2', 1, 'tenant_b')
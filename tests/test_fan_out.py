@@ -0,0 +1,36 @@
+import threading
+import time
+
+import pytest
+
+from projects.fan_out import run_concurrently
+from projects.structured_logging import request_id_var
+
+
+def test_run_concurrently_returns_results_in_order():
+    def slow():
+        time.sleep(0.05)
+        return 'slow'
+
+    assert run_concurrently(slow, lambda: 'fast') == ['slow', 'fast']
+
+
+def test_run_concurrently_overlaps_calls():
+    barrier = threading.Barrier(2, timeout=1)
+
+    # Both calls must be running at the same time to pass the barrier
+    assert run_concurrently(barrier.wait, barrier.wait) is not None
+
+
+def test_run_concurrently_raises_first_error():
+    def fail():
+        raise ValueError("User with UID 1 does not exist.")
+
+    with pytest.raises(ValueError, match="does not exist"):
+        run_concurrently(lambda: time.sleep(0.05), fail)
+
+
+def test_run_concurrently_keeps_request_id():
+    request_id_var.set('req-1')
+
+    assert run_concurrently(request_id_var.get) == ['req-1']
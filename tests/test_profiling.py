@@ -0,0 +1,114 @@
+import json
+import time
+from unittest import mock
+
+import pytest
+
+from projects.fan_out import run_concurrently
+from projects.profiling import (
+    LocalProfileSink, RequestProfiler, StorageProfileSink, sign_profile_token, timed)
+
+
+SECRET = 'profile_secret'
+
+
+class Wallets:
+    @timed
+    def rent_wallet(self):
+        time.sleep(0.02)
+        return 7
+
+
+def make_request(token=None):
+    request = mock.MagicMock()
+    request.headers = {'X-Profile-Token': token} if token else {}
+    return request
+
+
+@pytest.mark.parametrize("token, expected", [
+    (None, False),
+    (sign_profile_token(SECRET, time.time() + 60), True),
+    (sign_profile_token(SECRET, time.time() - 60), False),  # expired
+    (sign_profile_token('other_secret', time.time() + 60), False),
+    ('not-a-token', False),
+    (f"{int(time.time()) + 60}.\u00e9", False),  # non-ASCII signature
+    ('\u0661\u0662\u0663.abc', False),  # non-ASCII digits
+])
+def test_should_profile_signed_token(token, expected):
+    profiler = RequestProfiler(mock.MagicMock(), secret=SECRET)
+
+    assert profiler.should_profile(make_request(token)) is expected
+
+
+def test_should_profile_sample_rate():
+    profiler = RequestProfiler(mock.MagicMock(), sample_rate=0.5)
+
+    with mock.patch('random.random', side_effect=[0.2, 0.8]):
+        assert profiler.should_profile(make_request()) is True
+        assert profiler.should_profile(make_request()) is False
+
+
+def test_profile_off_does_not_write():
+    sink = mock.MagicMock()
+    profiler = RequestProfiler(sink, secret=SECRET)
+    handler = profiler.profile(lambda request: Wallets().rent_wallet())
+
+    assert handler(make_request()) == 7
+    sink.write.assert_not_called()
+
+
+def test_profile_writes_report_and_stacks(tmp_path):
+    profiler = RequestProfiler(LocalProfileSink(
+        str(tmp_path)), secret=SECRET, interval=0.001)
+
+    @profiler.profile
+    def rent_wallet(request):
+        return Wallets().rent_wallet()
+
+    assert rent_wallet(make_request(
+        sign_profile_token(SECRET, time.time() + 60))) == 7
+
+    report_path = next(tmp_path.glob('rent_wallet-*.json'))
+    report = json.loads(report_path.read_text())
+    folded = report_path.with_suffix('.folded').read_text()
+
+    assert report['wall_seconds'] >= 0.02
+    assert report['methods']['Wallets.rent_wallet']['calls'] == 1
+    assert report['samples'] > 0
+    assert 'rent_wallet (test_profiling.py' in folded
+
+
+def test_profile_samples_fan_out_threads(tmp_path):
+    profiler = RequestProfiler(LocalProfileSink(
+        str(tmp_path)), secret=SECRET, interval=0.001)
+
+    def read_user():
+        time.sleep(0.05)
+        return 'user_1'
+
+    @profiler.profile
+    def rent_wallet(request):
+        return run_concurrently(read_user, Wallets().rent_wallet)
+
+    assert rent_wallet(make_request(
+        sign_profile_token(SECRET, time.time() + 60))) == ['user_1', 7]
+
+    report_path = next(tmp_path.glob('rent_wallet-*.json'))
+    folded = report_path.with_suffix('.folded').read_text()
+    report = json.loads(report_path.read_text())
+
+    # The calls ran on fan out threads, their stacks are in the profile
+    assert 'read_user (test_profiling.py' in folded
+    assert report['methods']['Wallets.rent_wallet']['calls'] == 1
+
+
+def test_storage_sink_uploads_files():
+    client = mock.MagicMock()
+    sink = StorageProfileSink('profiles_bucket', client=client)
+
+    sink.write('rent_wallet-1', {'wall_seconds': 1}, 'a;b 1\n')
+
+    client.bucket.assert_called_once_with('profiles_bucket')
+    blob = client.bucket.return_value.blob
+    blob.assert_any_call('profiles/rent_wallet-1.json')
+    blob.assert_any_call('profiles/rent_wallet-1.folded')
@@ -0,0 +1,117 @@
+import importlib
+import sys
+from unittest import mock
+
+import pytest
+
+from projects.tenants import DEFAULT_TENANT
+
+
+@pytest.fixture
+def secure_db():
+    """Mock Secure project used by the handlers."""
+    secure_db = mock.MagicMock()
+    secure_db.rent_wallet.return_value = 7
+    return secure_db
+
+
+@pytest.fixture
+def handlers(secure_db):
+    """rent_wallet module imported with a mocked tenant registry."""
+    with mock.patch('projects.bootstrap.setup_logging'), \
+            mock.patch('projects.bootstrap.create_analytics', return_value=None), \
+            mock.patch('projects.bootstrap.create_registry') as create_registry:
+        sys.modules.pop('rent_wallet', None)
+        module = importlib.import_module('rent_wallet')
+
+    registry = create_registry.return_value
+    registry.resolve.return_value = DEFAULT_TENANT
+    registry.tenants = {DEFAULT_TENANT: {}}
+    registry.use.return_value.__enter__.return_value = (secure_db, mock.MagicMock())
+
+    yield module
+    sys.modules.pop('rent_wallet', None)
+
+
+@pytest.fixture
+def mock_queue(handlers):
+    """Mock Cloud Tasks expiry queue."""
+    queue = mock.MagicMock()
+    with mock.patch.object(handlers, 'get_expiry_queue', return_value=queue):
+        yield queue
+
+
+def make_request(body):
+    request = mock.MagicMock()
+    request.headers = {}
+    request.get_json.return_value = body
+    return request
+
+
+def test_rent_wallet_schedules_expiry(handlers, mock_queue, secure_db):
+    response = handlers.rent_wallet(make_request({'uid': 'user_1'}))
+
+    assert response == ({'status': 'success', 'walletNumber': 7}, 200)
+    secure_db.rent_wallet.assert_called_once_with('user_1')
+    mock_queue.schedule.assert_called_once_with('user_1', 7, mock.ANY, DEFAULT_TENANT)
+
+
+def test_rent_wallet_retries_schedule(handlers, mock_queue, secure_db):
+    mock_queue.schedule.side_effect = [RuntimeError('queue unavailable'), True]
+
+    response = handlers.rent_wallet(make_request({'uid': 'user_1'}))
+
+    assert response[1] == 200
+    assert mock_queue.schedule.call_count == 2
+    secure_db.expire_wallet.assert_not_called()
+
+
+def test_rent_wallet_releases_wallet_when_schedule_fails(handlers, mock_queue, secure_db):
+    mock_queue.schedule.side_effect = RuntimeError('queue unavailable')
+
+    response = handlers.rent_wallet(make_request({'uid': 'user_1'}))
+
+    assert response == (
+        {'status': 'failed', 'message': 'Could not schedule the wallet expiry'}, 503)
+    assert mock_queue.schedule.call_count == handlers.SCHEDULE_ATTEMPTS
+    secure_db.expire_wallet.assert_called_once_with('user_1', 7, force=True)
+
+
+def test_rent_wallet_requires_uid(handlers, mock_queue, secure_db):
+    assert handlers.rent_wallet(make_request({}))[1] == 400
+    secure_db.rent_wallet.assert_not_called()
+
+
+def test_rent_wallet_unknown_tenant(handlers, mock_queue, secure_db):
+    handlers.registry.resolve.side_effect = ValueError("Unknown tenant tenant_x")
+
+    assert handlers.rent_wallet(make_request({'uid': 'user_1'})) == (
+        {'status': 'failed', 'message': 'Unknown tenant tenant_x'}, 400)
+    secure_db.rent_wallet.assert_not_called()
+
+
+def test_expire_wallet_handler(handlers, secure_db):
+    response = handlers.expire_wallet(make_request(
+        {'uid': 'user_1', 'wallet_number': 7, 'tenant_id': None}))
+
+    assert response == ({'status': 'success', 'walletNumber': 7}, 200)
+    handlers.registry.use.assert_called_once_with(DEFAULT_TENANT)
+    secure_db.expire_wallet.assert_called_once_with('user_1', 7)
+
+
+@pytest.mark.parametrize("body", [
+    {'wallet_number': 7},  # no uid
+    {'uid': 'user_1'},  # no wallet number
+    None,  # no body
+])
+def test_expire_wallet_handler_missing_fields(body, handlers, secure_db):
+    assert handlers.expire_wallet(make_request(body))[1] == 400
+    secure_db.expire_wallet.assert_not_called()
+
+
+def test_expire_wallet_handler_unknown_tenant(handlers, secure_db):
+    response = handlers.expire_wallet(make_request(
+        {'uid': 'user_1', 'wallet_number': 7, 'tenant_id': 'tenant_x'}))
+
+    assert response == ({'status': 'failed', 'message': 'Unknown tenant tenant_x'}, 400)
+    secure_db.expire_wallet.assert_not_called()
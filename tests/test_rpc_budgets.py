@@ -0,0 +1,32 @@
+import pytest
+
+from tests.rpc_budget import METRICS, OPERATIONS, load_budgets, measure, report
+
+
+BUDGETS = load_budgets()
+
+
+def test_every_operation_has_a_budget():
+    assert set(OPERATIONS) == set(BUDGETS)
+
+
+@pytest.mark.parametrize("operation", sorted(OPERATIONS))
+def test_operation_within_rpc_budget(operation):
+    counts = measure(operation)
+
+    over_budget = {
+        metric: (counts[metric], BUDGETS[operation][metric])
+        for metric in METRICS if counts[metric] > BUDGETS[operation][metric]
+    }
+    assert not over_budget, f"{operation} is over its RPC budget (actual, budget): {over_budget}"
+
+
+def test_report_flags_operations_over_budget():
+    counts = dict.fromkeys(METRICS, 0)
+    budgets = {'deposit_within_rental': dict(counts, queries=3)}
+
+    text, over_budget = report(
+        budgets, {'deposit_within_rental': dict(counts, queries=4)})
+
+    assert over_budget == ['deposit_within_rental']
+    assert 'OVER' in text
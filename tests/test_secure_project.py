@@ -5,6 +5,11 @@ import pytest
 
 from datetime import datetime, timedelta, timezone
 
+from firebase_admin import firestore
+from google.api_core import exceptions
+
+from projects.wallet_pool import FreeWalletPool, InMemoryWalletQuery
+
 # Tests for Secure class
 
 
@@ -121,7 +126,9 @@ def test_deposit_to_wallet_within_rental_positive_amount(wallet_number, amount,
 
     # Check if wallet balance is updated
     new_balance = start_balance + amount
-    mock_wallet.reference.update.assert_any_call({'balance': new_balance})
+    mock_wallet.reference.update.assert_any_call(
+        {'balance': new_balance, 'last_activity': mock.ANY},
+        option=mock_firestore.write_option.return_value)
 
     # Check if the deposit was sent to the unsecure project
     mock_unsecure.update_user_balance.assert_called_with(wallet_number, amount)
@@ -131,6 +138,26 @@ def test_deposit_to_wallet_within_rental_positive_amount(wallet_number, amount,
     mock_unsecure.unlink_wallet_from_user.assert_called_with(wallet_number)
 
 
+def test_deposit_to_wallet_unsecure_failure_keeps_wallet_rented(secure_class, mock_unsecure, mock_firestore):
+    mock_wallet = mock.MagicMock()
+    mock_wallet.to_dict.return_value = {
+        'number': 2,
+        'balance': 100,
+        'rental_expiry': datetime.now(timezone.utc) + timedelta(minutes=5),
+        'is_rented': True
+    }
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = [
+        mock_wallet]
+    mock_unsecure.update_user_balance.side_effect = RuntimeError("unsecure down")
+
+    with pytest.raises(RuntimeError):
+        secure_class.deposit_to_wallet(wallet_number=2, amount=50)
+
+    # The wallet stays rented to the user whose balance was not updated
+    assert call({'is_rented': False}) not in mock_wallet.reference.update.call_args_list
+    mock_unsecure.unlink_wallet_from_user.assert_not_called()
+
+
 @pytest.mark.parametrize("amount", [
     (-1),  # negative with one digit
     (-10),  # negative with two digits
@@ -188,7 +215,9 @@ def test_deposit_to_wallet_expired_positive_amount(amount, secure_class, mock_fi
 
     # Check if wallet balance is updated but no unsecure updates are triggered
     new_balance = start_balance + amount
-    mock_wallet.reference.update.assert_any_call({'balance': new_balance})
+    mock_wallet.reference.update.assert_any_call(
+        {'balance': new_balance, 'last_activity': mock.ANY},
+        option=mock_firestore.write_option.return_value)
     mock_unsecure.update_user_balance.assert_not_called()
     mock_unsecure.unlink_wallet_from_user.assert_not_called()
 
@@ -221,3 +250,228 @@ def test_deposit_to_wallet_expired_negative_amount(amount, secure_class, mock_fi
 
     # Assert update was not called when the amount is negative
     mock_unsecure.reference.update.assert_not_called()
+
+
+def test_rent_wallet_records_rental_event(secure_class, mock_firestore, mock_analytics):
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([
+    ])
+
+    secure_class.rent_wallet(uid="user_456")
+
+    mock_analytics.record.assert_called_once_with(
+        'rental', tenant_id='tenant_a', uid="user_456", wallet_number=1)
+
+
+def test_deposit_to_wallet_records_deposit_and_expiry_events(secure_class, mock_firestore, mock_analytics):
+    mock_wallet = mock.MagicMock()
+    mock_wallet.to_dict.return_value = {
+        'number': 3,
+        'balance': 100,
+        'rental_expiry': datetime.now(timezone.utc) + timedelta(minutes=5),
+        'is_rented': True
+    }
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = [
+        mock_wallet]
+
+    secure_class.deposit_to_wallet(wallet_number=3, amount=50)
+
+    assert mock_analytics.record.call_args_list == [
+        call('deposit', tenant_id='tenant_a', wallet_number=3, amount=50),
+        call('expiry', tenant_id='tenant_a', wallet_number=3),
+    ]
+
+
+def make_pool_wallet(wallet_id, number):
+    wallet = mock.MagicMock()
+    wallet.id = wallet_id
+    wallet.to_dict.return_value = {'number': number, 'balance': 0, 'is_rented': False}
+    return wallet
+
+
+def test_rent_wallet_from_pool(secure_class, mock_firestore, mock_unsecure):
+    wallet = make_pool_wallet('w7', 7)
+    secure_class.wallet_pool = FreeWalletPool(InMemoryWalletQuery([wallet]))
+    secure_class.wallet_pool.start()
+
+    wallet_number = secure_class.rent_wallet(uid="user_1")
+
+    assert wallet_number == 7
+    # The wallet is claimed with a conditional write and without a query
+    mock_firestore.write_option.assert_called_once_with(
+        last_update_time=wallet.update_time)
+    wallet.reference.update.assert_called_once_with(
+        {'is_rented': True, 'rental_expiry': mock.ANY},
+        option=mock_firestore.write_option.return_value)
+    mock_firestore.collection.return_value.where.assert_not_called()
+    mock_unsecure.link_wallet_to_user.assert_called_with('user_1', 7)
+
+
+def test_rent_wallet_from_pool_stale_wallet(secure_class, mock_firestore, mock_unsecure):
+    stale_wallet = make_pool_wallet('w1', 1)
+    stale_wallet.reference.update.side_effect = exceptions.FailedPrecondition(
+        'wallet changed')
+    secure_class.wallet_pool = FreeWalletPool(
+        InMemoryWalletQuery([stale_wallet]))
+    secure_class.wallet_pool.start()
+
+    # The pool is empty after the stale wallet, the query finds wallet 2
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([
+        make_pool_wallet('w2', 2)])
+
+    wallet_number = secure_class.rent_wallet(uid="user_1")
+
+    assert wallet_number == 2
+    mock_unsecure.link_wallet_to_user.assert_called_once_with('user_1', 2)
+
+
+def test_rent_wallet_from_pool_missing_user_keeps_wallet(secure_class, mock_unsecure):
+    wallet = make_pool_wallet('w7', 7)
+    secure_class.wallet_pool = FreeWalletPool(InMemoryWalletQuery([wallet]))
+    secure_class.wallet_pool.start()
+    mock_unsecure.db.collection.return_value.document.return_value.get.return_value.exists = False
+
+    with pytest.raises(ValueError):
+        secure_class.rent_wallet(uid="missing_user")
+
+    # The wallet was not rented, it is still in the mirror
+    assert secure_class.wallet_pool.take() is wallet
+
+
+def test_rent_wallet_from_pool_claim_error_keeps_wallet(secure_class, mock_unsecure):
+    wallet = make_pool_wallet('w7', 7)
+    wallet.reference.update.side_effect = exceptions.ServiceUnavailable('timeout')
+    secure_class.wallet_pool = FreeWalletPool(InMemoryWalletQuery([wallet]))
+    secure_class.wallet_pool.start()
+
+    with pytest.raises(exceptions.ServiceUnavailable):
+        secure_class.rent_wallet(uid="user_1")
+
+    assert secure_class.wallet_pool.take() is wallet
+
+
+def test_deposit_to_wallet_rehydrates_archived_wallet(secure_class, mock_firestore, mock_unsecure):
+    tombstone = mock.MagicMock()
+    tombstone.to_dict.return_value = {
+        'number': 9, 'archived': True, 'archive_chunk': 'wallets-1.ndjson.gz'}
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = [
+        tombstone]
+
+    restored = mock.MagicMock()
+    restored.to_dict.return_value = {
+        'number': 9,
+        'balance': 100,
+        'rental_expiry': datetime.now(timezone.utc) - timedelta(days=100),
+        'is_rented': False
+    }
+    secure_class.archiver = mock.MagicMock()
+    secure_class.archiver.rehydrate.return_value = restored
+
+    secure_class.deposit_to_wallet(wallet_number=9, amount=50)
+
+    secure_class.archiver.rehydrate.assert_called_once_with(tombstone)
+    restored.reference.update.assert_called_once_with(
+        {'balance': 150, 'last_activity': mock.ANY},
+        option=mock_firestore.write_option.return_value)
+    tombstone.reference.update.assert_not_called()
+    mock_unsecure.update_user_balance.assert_not_called()
+
+
+def test_deposit_to_wallet_retries_when_wallet_changed(secure_class, mock_firestore, mock_unsecure):
+    mock_wallet = mock.MagicMock()
+    mock_wallet.to_dict.return_value = {
+        'number': 4,
+        'balance': 100,
+        'rental_expiry': datetime.now(timezone.utc) - timedelta(minutes=5),
+        'is_rented': False
+    }
+    mock_wallet.reference.update.side_effect = exceptions.FailedPrecondition(
+        'wallet changed')
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = [
+        mock_wallet]
+
+    # Another deposit was written after the wallet was read
+    fresh_wallet = mock_wallet.reference.get.return_value
+    fresh_wallet.to_dict.return_value = dict(mock_wallet.to_dict.return_value, balance=130)
+
+    secure_class.deposit_to_wallet(wallet_number=4, amount=50)
+
+    fresh_wallet.reference.update.assert_called_once_with(
+        {'balance': 180, 'last_activity': mock.ANY},
+        option=mock_firestore.write_option.return_value)
+
+
+def test_restore_wallet_checks_again_after_rehydrate(secure_class):
+    tombstone = mock.MagicMock()
+    tombstone.to_dict.return_value = {'number': 9, 'archived': True}
+    restored = mock.MagicMock()
+    restored.to_dict.return_value = {'number': 9, 'balance': 100}
+
+    # The first rehydrate lost a race and returned the wallet still archived
+    secure_class.archiver = mock.MagicMock()
+    secure_class.archiver.rehydrate.side_effect = [tombstone, restored]
+
+    assert secure_class.restore_wallet(tombstone) is restored
+    assert secure_class.archiver.rehydrate.call_count == 2
+
+
+def test_deposit_to_wallet_archived_without_archiver(secure_class, mock_firestore, mock_unsecure):
+    tombstone = mock.MagicMock()
+    tombstone.to_dict.return_value = {
+        'number': 9, 'archived': True, 'archive_chunk': 'wallets-1.ndjson.gz'}
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = [
+        tombstone]
+
+    with pytest.raises(ValueError, match="Wallet 9 is archived and no archive store is set."):
+        secure_class.deposit_to_wallet(wallet_number=9, amount=50)
+
+    tombstone.reference.update.assert_not_called()
+    mock_unsecure.update_user_balance.assert_not_called()
+
+
+def make_rented_wallet(mock_firestore, rental_expiry, is_rented=True):
+    wallet = mock.MagicMock()
+    wallet.to_dict.return_value = {
+        'number': 4, 'is_rented': is_rented, 'rental_expiry': rental_expiry}
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([
+        wallet])
+    return wallet
+
+
+def test_expire_wallet(secure_class, mock_firestore, mock_unsecure):
+    wallet = make_rented_wallet(
+        mock_firestore, datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    assert secure_class.expire_wallet('user_1', 4) is True
+
+    wallet.reference.update.assert_called_once_with({'is_rented': False})
+    mock_unsecure.db.collection.return_value.document.assert_called_with('user_1')
+    mock_unsecure.db.collection.return_value.document.return_value.update.assert_called_once_with(
+        {'rented_wallet': firestore.DELETE_FIELD})
+
+
+def test_expire_wallet_rented_again(secure_class, mock_firestore, mock_unsecure):
+    """Test a stale expiry task does not release a wallet rented again"""
+    wallet = make_rented_wallet(
+        mock_firestore, datetime.now(timezone.utc) + timedelta(minutes=4))
+
+    assert secure_class.expire_wallet('user_1', 4) is False
+
+    wallet.reference.update.assert_not_called()
+    mock_unsecure.db.collection.return_value.document.return_value.update.assert_not_called()
+
+
+def test_expire_wallet_force(secure_class, mock_firestore):
+    """Test force releases the wallet before the end of the rental period"""
+    wallet = make_rented_wallet(
+        mock_firestore, datetime.now(timezone.utc) + timedelta(minutes=4))
+
+    assert secure_class.expire_wallet('user_1', 4, force=True) is True
+    wallet.reference.update.assert_called_once_with({'is_rented': False})
+
+
+def test_expire_wallet_already_expired(secure_class, mock_firestore):
+    wallet = make_rented_wallet(
+        mock_firestore, datetime.now(timezone.utc) - timedelta(minutes=1), is_rented=False)
+
+    assert secure_class.expire_wallet('user_1', 4) is False
+    wallet.reference.update.assert_not_called()
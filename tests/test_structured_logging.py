@@ -0,0 +1,105 @@
+import json
+import logging
+import queue
+import sys
+from unittest import mock
+
+import pytest
+
+from projects.structured_logging import (
+    JsonFormatter, RequestIdFilter, SamplingFilter, TracebackQueueHandler, request_id_var,
+    set_request_id, tenant_id_var)
+
+
+def make_record(level=logging.INFO, event=None):
+    extra = {'event': event, 'wallet_number': 5} if event else {}
+    record = logging.LogRecord(
+        'projects.secure_project', level, __file__, 1, "Deposited %s", (10,), None)
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.mark.parametrize("headers, request_id", [
+    ({'X-Cloud-Trace-Context': 'abc123/456;o=1'}, 'abc123'),
+    ({'X-Request-ID': 'req-1'}, 'req-1'),
+])
+def test_set_request_id_from_headers(headers, request_id):
+    request = mock.MagicMock()
+    request.headers = headers
+
+    assert set_request_id(request) == request_id
+    assert request_id_var.get() == request_id
+
+
+def test_set_request_id_generated():
+    request = mock.MagicMock()
+    request.headers = {}
+
+    request_id = set_request_id(request)
+
+    assert len(request_id) == 32
+    assert request_id_var.get() == request_id
+
+
+def test_json_formatter_adds_request_id_and_extra_fields():
+    request_id_var.set('req-1')
+    record = make_record(event='deposit')
+    RequestIdFilter().filter(record)
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry == {
+        'severity': 'INFO',
+        'message': 'Deposited 10',
+        'logger': 'projects.secure_project',
+        'request_id': 'req-1',
+        'tenant_id': None,
+        'event': 'deposit',
+        'wallet_number': 5,
+    }
+
+
+def test_request_id_filter_adds_tenant():
+    record = make_record(event='deposit')
+
+    token = tenant_id_var.set('tenant_a')
+    try:
+        RequestIdFilter().filter(record)
+    finally:
+        tenant_id_var.reset(token)
+
+    assert json.loads(JsonFormatter().format(record))['tenant_id'] == 'tenant_a'
+
+
+def test_sampling_filter():
+    sampling = SamplingFilter({'deposit': 0, 'balance_updated': 1})
+
+    assert sampling.filter(make_record(event='deposit')) is False
+    assert sampling.filter(make_record(event='balance_updated')) is True
+    assert sampling.filter(make_record()) is True
+    # Warnings are kept whatever the sample rate
+    assert sampling.filter(make_record(logging.WARNING, 'deposit')) is True
+
+
+def test_sampling_filter_partial_rate():
+    sampling = SamplingFilter({'deposit': 0.5})
+
+    with mock.patch('random.random', side_effect=[0.2, 0.8]):
+        assert sampling.filter(make_record(event='deposit')) is True
+        assert sampling.filter(make_record(event='deposit')) is False
+
+
+def test_queue_handler_keeps_traceback():
+    log_queue = queue.SimpleQueue()
+    try:
+        raise ValueError("wallet not found")
+    except ValueError:
+        record = logging.LogRecord(
+            'projects.secure_project', logging.ERROR, __file__, 1, "Failed %s", (5,),
+            sys.exc_info())
+
+    TracebackQueueHandler(log_queue).emit(record)
+    entry = json.loads(JsonFormatter().format(log_queue.get()))
+
+    assert entry['message'] == 'Failed 5'
+    assert 'ValueError: wallet not found' in entry['exception']
@@ -0,0 +1,178 @@
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from projects.structured_logging import tenant_id_var
+from projects.tenants import DEFAULT_TENANT, SECURE_PROJECT_ID, TenantRegistry, load_tenants
+
+
+TENANTS = {
+    DEFAULT_TENANT: {'secure_project_id': 'secure_project', 'unsecure_project_id': 'unsecure_project'},
+    'tenant_a': {'secure_project_id': 'secure_a', 'unsecure_project_id': 'unsecure_a'},
+    'tenant_b': {'secure_project_id': 'secure_b', 'unsecure_project_id': 'unsecure_b'},
+}
+
+
+@pytest.fixture
+def mock_delete_app():
+    """Mock firebase_admin.delete_app."""
+    with mock.patch('firebase_admin.delete_app') as mock_delete:
+        yield mock_delete
+
+
+@pytest.fixture
+def registry(mock_firestore, mock_firebase_init, mock_firebase_credentials, mock_delete_app):
+    """Fixture for the TenantRegistry class."""
+    with mock.patch('firebase_admin.firestore.client', return_value=mock_firestore):
+        with mock.patch('google.cloud.pubsub_v1.PublisherClient'):
+            yield TenantRegistry(TENANTS, max_tenants=2, idle_seconds=60)
+
+
+def make_request(tenant_id=None):
+    request = mock.MagicMock()
+    request.headers = {'X-Tenant-ID': tenant_id} if tenant_id else {}
+    return request
+
+
+def test_load_tenants():
+    tenants_env = '{"tenant_a": {"secure_project_id": "secure_a", "unsecure_project_id": "unsecure_a"}}'
+
+    with mock.patch.dict(os.environ, {'TENANTS': tenants_env}):
+        tenants = load_tenants()
+
+    assert tenants[DEFAULT_TENANT]['secure_project_id'] == SECURE_PROJECT_ID
+    assert tenants['tenant_a'] == {'secure_project_id': 'secure_a', 'unsecure_project_id': 'unsecure_a'}
+
+
+@pytest.mark.parametrize("tenant_id, expected", [
+    (None, DEFAULT_TENANT),
+    ('tenant_a', 'tenant_a'),
+])
+def test_resolve(tenant_id, expected, registry):
+    assert registry.resolve(make_request(tenant_id)) == expected
+
+
+def test_resolve_unknown_tenant(registry):
+    with pytest.raises(ValueError, match="Unknown tenant tenant_x"):
+        registry.resolve(make_request('tenant_x'))
+
+
+def test_get_pools_projects(registry, mock_firebase_init):
+    with registry.use(registry.resolve(make_request('tenant_a'))) as (secure_db, unsecure_db):
+        assert registry.get('tenant_a') == (secure_db, unsecure_db)
+
+    assert secure_db.unsecure_db is unsecure_db
+    # initialize_app is only called once for each project of the tenant
+    assert mock_firebase_init.call_count == 2
+    assert mock_firebase_init.call_args_list[0].kwargs['name'] == 'tenant_a_unsecure_app'
+
+
+def test_get_evicts_least_recently_used(registry, mock_firebase_init, mock_delete_app):
+    registry.get(DEFAULT_TENANT)
+    registry.get('tenant_a')
+    registry.get(DEFAULT_TENANT)
+    registry.get('tenant_b')
+
+    # tenant_a was the least recently used one
+    assert mock_delete_app.call_count == 2
+    registry.get(DEFAULT_TENANT)
+    assert mock_firebase_init.call_count == 6
+
+
+def test_evict_idle(registry, mock_delete_app):
+    with mock.patch('time.monotonic', return_value=0):
+        registry.get('tenant_a')
+
+    with mock.patch('time.monotonic', return_value=30):
+        registry.get('tenant_b')
+
+    with mock.patch('time.monotonic', return_value=70):
+        registry.evict_idle()
+
+    assert mock_delete_app.call_count == 2
+
+    registry.close()
+    assert mock_delete_app.call_count == 4
+
+
+def test_get_secure_failure_deletes_unsecure_app(registry, mock_delete_app):
+    with mock.patch('projects.tenants.Secure', side_effect=RuntimeError("bad credentials")), \
+            mock.patch('firebase_admin.get_app', side_effect=ValueError("no app")):
+        with pytest.raises(RuntimeError):
+            registry.get('tenant_a')
+
+    # The Unsecure app of the failed tenant is deleted, nothing is pooled
+    mock_delete_app.assert_called_once()
+    assert not registry._projects
+
+
+def test_close_failure_still_closes_other_side(registry, mock_delete_app):
+    secure_db, unsecure_db = registry.get('tenant_a')
+    secure_db.publisher.stop.side_effect = RuntimeError("publisher stuck")
+
+    registry.close()
+
+    # Only the Unsecure app could be deleted, and it was
+    mock_delete_app.assert_called_once_with(unsecure_db.app)
+
+
+def test_evicted_tenant_closed_after_release(registry, mock_delete_app):
+    with registry.use('tenant_a') as (secure_db, _):
+        registry.get(DEFAULT_TENANT)
+        registry.get('tenant_b')
+
+        # tenant_a was evicted but the request still uses it
+        mock_delete_app.assert_not_called()
+        assert secure_db.db is not None
+
+    assert mock_delete_app.call_count == 2
+
+
+def test_draining_tenant_is_reused(registry, mock_firebase_init, mock_delete_app):
+    with registry.use('tenant_a') as projects:
+        registry.get(DEFAULT_TENANT)
+        registry.get('tenant_b')
+
+        # The evicted apps are still registered, so they are reused
+        assert registry.get('tenant_a') == projects
+
+    mock_delete_app.assert_called()
+    assert mock_firebase_init.call_count == 6
+
+
+def test_tenant_created_outside_lock(registry):
+    create = registry._create
+    evicted = threading.Event()
+
+    def slow_create(tenant_id):
+        # Another thread can use the registry while the tenant is built
+        thread = threading.Thread(target=lambda: (registry.evict_idle(), evicted.set()))
+        thread.start()
+        thread.join(timeout=1)
+        return create(tenant_id)
+
+    with mock.patch.object(registry, '_create', side_effect=slow_create):
+        registry.get('tenant_a')
+
+    assert evicted.is_set()
+
+
+def test_use_sets_tenant(registry):
+    with registry.use('tenant_a') as (secure_db, _):
+        assert secure_db.tenant_id == 'tenant_a'
+        assert tenant_id_var.get() == 'tenant_a'
+
+    assert tenant_id_var.get() is None
+
+
+def test_recreated_tenant_keeps_wallet_number(registry):
+    secure_db, _ = registry.get('tenant_a')
+    secure_db.wallet_number = 5
+
+    registry.get(DEFAULT_TENANT)
+    registry.get('tenant_b')  # tenant_a is evicted
+
+    secure_db, _ = registry.get('tenant_a')
+    assert secure_db.wallet_number == 5
@@ -216,3 +216,16 @@ def test_update_user_balance_no_wallet(unsecure_class, mock_firestore):
 
     # Ensure no Firestore update is attempted if no matching user is found
     mock_firestore.collection('users').document().update.assert_not_called()
+
+
+def test_update_user_balance_no_wallet_logs_warning(unsecure_class, mock_firestore, caplog):
+    """Test the missing user is reported as a structured warning"""
+
+    mock_firestore.collection.return_value.where.return_value.limit.return_value.get.return_value = []
+
+    unsecure_class.update_user_balance(6666, 50)
+
+    record = caplog.records[-1]
+    assert record.levelname == 'WARNING'
+    assert record.event == 'balance_user_not_found'
+    assert record.wallet_number == 6666
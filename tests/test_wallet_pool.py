@@ -0,0 +1,105 @@
+from unittest import mock
+
+from projects.wallet_pool import FreeWalletPool, InMemoryWalletQuery
+
+
+def make_wallet(wallet_id):
+    wallet = mock.MagicMock()
+    wallet.id = wallet_id
+    return wallet
+
+
+def test_pool_not_ready_before_start():
+    pool = FreeWalletPool(InMemoryWalletQuery([make_wallet('w1')]))
+
+    assert pool.is_ready() is False
+    assert pool.staleness() is None
+    assert pool.take() is None
+
+
+def test_pool_take_removes_wallet():
+    wallet = make_wallet('w1')
+    pool = FreeWalletPool(InMemoryWalletQuery([wallet]))
+    pool.start()
+
+    assert pool.is_ready() is True
+    assert pool.take() is wallet
+    assert pool.take() is None
+    assert pool.staleness() >= 0
+
+
+def test_pool_follows_changes():
+    query = InMemoryWalletQuery([make_wallet('w1')])
+    pool = FreeWalletPool(query)
+    pool.start()
+
+    # w1 was rented by another instance, w2 was expired
+    query.push(make_wallet('w1'), 'REMOVED')
+    wallet = make_wallet('w2')
+    query.push(wallet, 'ADDED')
+
+    assert pool.take() is wallet
+    assert pool.take() is None
+
+
+def test_pool_resyncs_after_disconnect():
+    query = InMemoryWalletQuery([make_wallet('w1')])
+    pool = FreeWalletPool(query)
+    pool.start()
+
+    # The listener dropped, changes pushed meanwhile are missed
+    query.watches[0].is_active = False
+    query.push(make_wallet('w2'), 'ADDED')
+
+    assert pool.is_ready() is False
+    assert pool.take() is None  # Falls back to the query while resyncing
+    assert pool.resyncs == 1
+
+    # The new listener starts from the full result
+    assert {pool.take().id, pool.take().id} == {'w1', 'w2'}
+
+
+def test_pool_stop():
+    query = InMemoryWalletQuery([make_wallet('w1')])
+    pool = FreeWalletPool(query)
+    pool.start()
+    pool.stop()
+
+    assert query.watches[0].is_active is False
+    assert pool.take() is None
+
+
+def test_pool_put_back():
+    wallet = make_wallet('w1')
+    pool = FreeWalletPool(InMemoryWalletQuery([wallet]))
+    pool.start()
+
+    pool.put_back(pool.take())
+
+    assert pool.take() is wallet
+
+
+def test_pool_quiet_listener_stays_ready():
+    query = InMemoryWalletQuery([make_wallet('w1')])
+    pool = FreeWalletPool(query)
+    pool.start()
+
+    # No change for an hour, the listener is still connected
+    with mock.patch('time.monotonic', return_value=pool._last_snapshot + 3600):
+        assert pool.is_ready() is True
+        assert pool.take().id == 'w1'
+
+    assert pool.resyncs == 0
+
+
+def test_pool_resync_runs_once_at_a_time():
+    query = InMemoryWalletQuery([make_wallet('w1')])
+    pool = FreeWalletPool(query)
+    pool.start()
+    query.watches[0].is_active = False
+
+    # Another request is already restarting the listener
+    with pool._resync_lock:
+        pool.resync()
+
+    assert pool.resyncs == 0